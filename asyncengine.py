@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+
+from main import Engine
+
+class AsyncEngine:															# asyncio-обёртка над Engine: база меняется в том же обработчике очереди
+	def __init__( self, cfg = None, outFunc = None, engine = None ):
+		if engine == None:
+			engine = Engine( outFunc )
+			if cfg == None:
+				engine.loadCfg()
+			else:
+				engine.cfg = cfg
+		self.engine = engine
+		self.engine.listeners.append( self._onEvent )
+		self.subscribers = []												# ( цикл, очередь ) каждого, кто читает events()
+
+	async def start( self, dbFile = None ):									# Загрузка базы из SQLite - вне цикла событий
+		await asyncio.get_running_loop().run_in_executor( None, self.engine.start, dbFile )
+
+	async def stop( self ):
+		await asyncio.get_running_loop().run_in_executor( None, self.engine.stop )
+
+	async def _submit( self, work ):										# Выполняет work() в потоке обработчика и ждёт результат
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		def done( result, error ):
+			if not future.cancelled():
+				if error != None:
+					future.set_exception( error )
+				else:
+					future.set_result( result )
+		def run():
+			try:
+				result = work()
+			except Exception as e:
+				loop.call_soon_threadsafe( done, None, e )
+			else:
+				loop.call_soon_threadsafe( done, result, None )
+		await loop.run_in_executor( None, self.engine.queue.put, ( 'call', run ) )	# Полная очередь не блокирует цикл событий
+		return await future
+
+	async def find( self, flags = {}, **pattern ):
+		return await self._submit( lambda: self.engine.db.find( flags, **pattern ) )
+
+	async def query( self, expr ):
+		return await self._submit( lambda: self.engine.db.query( expr ) )
+
+	async def add( self, flags = {}, **data ):								# Хэш считается в пуле потоков, а не в обработчике
+		if not data.get( 'hash' ) and not flags.get( 'lazy', False ):
+			path = os.path.join( self.engine.cfg[0], data.get( 'dir' ) or '', data['file'] )
+			st, data['hash'] = await asyncio.get_running_loop().run_in_executor( None, self.engine.statAndHash, path )
+			if st and not data.get( 'stat' ):
+				data['stat'] = st
+		return await self._submit( lambda: self.engine.db.add( flags, **data ) )
+
+	async def remove( self, **pattern ):
+		return await self._submit( lambda: self.engine.db.remove( **pattern ) )
+
+	def _onEvent( self, event ):
+		for loop, queue in list( self.subscribers ):
+			loop.call_soon_threadsafe( queue.put_nowait, event )
+
+	async def events( self ):												# Асинхронный итератор событий, уже применённых к базе
+		subscriber = ( asyncio.get_running_loop(), asyncio.Queue() )
+		self.subscribers.append( subscriber )
+		try:
+			while True:
+				yield await subscriber[1].get()
+		finally:
+			self.subscribers.remove( subscriber )
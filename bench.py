@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Нагрузочные замеры DataBase и Engine на синтетической библиотеке, результат - JSON для сравнения запусков:
+#   python bench.py --records 100000 --files 2000 --output bench.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import platform
+import threading
+import watchdog.events
+
+try:
+	import resource															# Нет на Windows - тогда без пиковой памяти
+except ImportError:
+	resource = None
+
+import fileutils
+
+from main import Engine
+from database import DataBase
+
+FILE_SIZES = ( 2**10, 2**14, 2**17, 2**20, 2**22 )							# Смесь мелких превью и крупных фото
+DIRS = 20
+
+def percentile( values, p ):
+	if not values:
+		return None
+	values = sorted( values )
+	return values[min( len( values ) - 1, int( len( values ) * p / 100 ) )]
+
+def summary( latencies, total = None ):										# Пропускная способность и задержки в миллисекундах
+	total = total if total != None else sum( latencies )
+	return { 'ops': len( latencies ), 'seconds': total, 'ops_per_sec': len( latencies ) / total if total else None,
+			 'p50_ms': ( percentile( latencies, 50 ) or 0 ) * 1000, 'p99_ms': ( percentile( latencies, 99 ) or 0 ) * 1000 }
+
+def timeit( func, args ):
+	latencies = []
+	for a in args:
+		start = time.perf_counter()
+		func( *a )
+		latencies.append( time.perf_counter() - start )
+	return summary( latencies )
+
+def peak_rss():																# Пиковая память процесса в байтах
+	if resource == None:
+		return None
+	rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+def synthetic_records( n, rnd ):											# Записи без файлов на диске: все поля заданы, диск не читается
+	for i in range( n ):
+		yield { 'file': 'img_{0}.jpg'.format( i ), 'dir': 'dir_{0}'.format( i % DIRS ), 'size': rnd.choice( FILE_SIZES ) + i % 97,
+				'created': 1400000000 + i, 'hash': hashlib.sha256( str( i ).encode() ).hexdigest(),
+				'tags': { 'Unsorted' } if i % 10 else { 'Unsorted', 'tag_{0}'.format( i % 50 ) }, 'stat': ( 1, 1, 0, 0 ), 'sample': 'x' }
+
+def bench_database( n, queries, rnd ):
+	res = {}
+	db = DataBase()
+	records = list( synthetic_records( n, rnd ) )
+	res['add_many'] = timeit( db.add_many, [ ( records[i:i + 1000], ) for i in range( 0, n, 1000 ) ] )	# Задержки - на пачку из 1000
+	res['add_many']['records_per_sec'] = n / res['add_many']['seconds']
+	picks = [ records[rnd.randrange( n )] for i in range( queries ) ]
+	res['find_path'] = timeit( lambda r: db.find( flags = { 're': False }, file = r['file'], dir = r['dir'] ), [ ( r, ) for r in picks ] )
+	res['find_hash'] = timeit( lambda r: db.find( hash = r['hash'] ), [ ( r, ) for r in picks ] )
+	res['find_size'] = timeit( lambda r: db.find( size = r['size'] ), [ ( r, ) for r in picks[:max( 1, queries // 10 )] ] )
+	res['find_prefix'] = timeit( lambda r: db.find( flags = { 're': True }, dir = '^' + r['dir'] + '$' ), [ ( r, ) for r in picks[:max( 1, queries // 10 )] ] )
+	res['query_tags'] = timeit( lambda r: db.query( 'tag_7 & !tag_8' ), [ ( r, ) for r in picks[:max( 1, queries // 10 )] ] )
+	res['remove'] = timeit( lambda r: db.remove( file = r['file'], dir = r['dir'] ), [ ( r, ) for r in { id( r ): r for r in picks }.values() ] )
+	return res
+
+def make_tree( root, files, rnd ):											# Синтетическое дерево: корень / папка / файл
+	paths = []
+	for i in range( files ):
+		d = os.path.join( root, 'dir_{0}'.format( i % DIRS ) )
+		os.makedirs( d, exist_ok = True )
+		path = os.path.join( d, 'img_{0}.jpg'.format( i ) )
+		with open( path, 'wb' ) as f:
+			f.write( rnd.randbytes( rnd.choice( FILE_SIZES ) ) )
+		paths.append( path )
+	return paths
+
+def bench_hash( paths ):
+	total = sum( os.path.getsize( p ) for p in paths )
+	res = timeit( fileutils.get_hash, [ ( p, ) for p in paths ] )
+	res['mb_per_sec'] = total / 2**20 / res['seconds'] if res['seconds'] else None
+	return res
+
+def new_engine( root ):
+	engine = Engine()
+	engine.cfg = [ root ]
+	engine.db.db = { 'dir': root, 'tags': {}, 'media': [] }
+	engine.coalescer.quiet = 0
+	return engine
+
+def storm( engine, events ):												# События идут в on_any_event, обработчик работает в своём потоке
+	worker = threading.Thread( target = Engine.worker, args = ( engine, ) )
+	worker.start()
+	latencies = []
+	start = time.perf_counter()
+	for ev in events:
+		t = time.perf_counter()
+		engine.on_any_event( ev )
+		latencies.append( time.perf_counter() - t )
+	engine.coalescer.flush( force = True )
+	engine.queue.put( 'quit' )
+	worker.join()
+	res = summary( latencies, time.perf_counter() - start )
+	res['receive_p50_ms'], res['receive_p99_ms'] = res.pop( 'p50_ms' ), res.pop( 'p99_ms' )
+	res['records'] = len( engine.db.db['media'] )
+	res['max_queue_lag_ms'] = engine.queue.stats()['max_lag'] * 1000
+	return res
+
+def bench_engine( root, paths ):
+	res = {}
+	engine = new_engine( root )
+	res['bulk_copy'] = storm( engine, [ watchdog.events.FileCreatedEvent( p ) for p in paths ] )
+	res['prepare_event'] = timeit( lambda p: engine.prepareEvent( p, root, Engine.SETTLED_ACTIONS['modified'] ),
+								   [ ( p, ) for p in paths[:200] ] )
+
+	old, new = os.path.join( root, 'dir_0' ), os.path.join( root, 'dir_renamed' )	# Так watchdog сообщает о переименовании папки
+	os.rename( old, new )
+	moved = [ p for p in paths if os.path.dirname( p ) == old ]
+	res['dir_rename'] = storm( engine, [ watchdog.events.FileMovedEvent( p, os.path.join( new, os.path.basename( p ) ) ) for p in moved ] )
+
+	alive = [ os.path.join( new, os.path.basename( p ) ) if p in moved else p for p in paths ]
+	shutil.rmtree( root )
+	res['mass_delete'] = storm( engine, [ watchdog.events.FileDeletedEvent( p ) for p in alive ] )
+	return res
+
+def run( records = 10000, files = 1000, queries = 1000, seed = 0 ):
+	rnd = random.Random( seed )
+	res = { 'python': platform.python_version(), 'platform': platform.platform(),
+			'params': { 'records': records, 'files': files, 'queries': queries, 'seed': seed } }
+	res['database'] = bench_database( records, queries, rnd )
+	root = tempfile.mkdtemp( prefix = 'pymm_bench_' )
+	try:
+		paths = make_tree( root, files, rnd )
+		res['get_hash'] = bench_hash( paths )
+		res['engine'] = bench_engine( root, paths )
+	finally:
+		shutil.rmtree( root, ignore_errors = True )
+	res['peak_rss_bytes'] = peak_rss()
+	return res
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser( description = 'Замеры производительности pyMediaMonitor' )
+	parser.add_argument( '--records', type = int, default = 10000, help = 'записей в синтетической базе ( 10k - 1M )' )
+	parser.add_argument( '--files', type = int, default = 1000, help = 'файлов в синтетическом дереве' )
+	parser.add_argument( '--queries', type = int, default = 1000 )
+	parser.add_argument( '--seed', type = int, default = 0 )
+	parser.add_argument( '--output', help = 'куда записать JSON ( по умолчанию - в stdout )' )
+	args = parser.parse_args()
+	result = json.dumps( run( args.records, args.files, args.queries, args.seed ), indent = 2 )
+	if args.output:
+		with open( args.output, 'w' ) as f:
+			f.write( result + '\n' )
+	else:
+		print( result )
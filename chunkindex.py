@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import sqlite3
+import threading
+import metrics
+import fileutils
+
+class ChunkIndex:															# Хэши кусков больших файлов: изменённый файл пересчитывается только там, где изменился
+	SAVE_EVERY = 64															# Столько новых кусков - и прогресс сохраняется, прерванный подсчёт продолжится с них
+
+	def __init__( self, dbFile = ':memory:', bits = fileutils.CHUNK_BITS, minSize = fileutils.CHUNK_MIN, maxSize = fileutils.CHUNK_MAX ):
+		self.dbFile = dbFile
+		self.bits, self.minSize, self.maxSize = bits, minSize, maxSize
+		self.conn = sqlite3.connect( dbFile, check_same_thread = False )
+		self.lock = threading.RLock()
+		with self.lock:
+			self.conn.executescript( '''
+				CREATE TABLE IF NOT EXISTS files ( path TEXT PRIMARY KEY, stat BLOB, complete INTEGER );
+				CREATE TABLE IF NOT EXISTS chunks ( path TEXT, offset INTEGER, length INTEGER, digest TEXT, PRIMARY KEY ( path, offset ) );
+				CREATE TABLE IF NOT EXISTS stale ( path TEXT, offset INTEGER, length INTEGER, digest TEXT, PRIMARY KEY ( path, offset ) );
+				CREATE INDEX IF NOT EXISTS chunks_digest ON chunks ( digest );
+			''' )
+			self.conn.commit()
+
+	def chunks( self, path, table = 'chunks' ):								# [ ( смещение, длина, хэш ) ] по порядку
+		with self.lock:
+			return self.conn.execute( 'SELECT offset, length, digest FROM {0} WHERE path = ? ORDER BY offset'.format( table ), ( path, ) ).fetchall()
+
+	def state( self, path ):												# ( подпись файла, полностью ли посчитан ) или None
+		with self.lock:
+			row = self.conn.execute( 'SELECT stat, complete FROM files WHERE path = ?', ( path, ) ).fetchone()
+		return ( pickle.loads( row[0] ), bool( row[1] ) ) if row != None else None
+
+	def unfinished( self, path ):											# Подсчёт прерван, а файл с тех пор не менялся - можно продолжить
+		state = self.state( path )
+		return state != None and not state[1] and state[0] == fileutils.get_stat( path )
+
+	def pending( self ):													# Файлы с прерванным подсчётом
+		with self.lock:
+			return [ row[0] for row in self.conn.execute( 'SELECT path FROM files WHERE complete = 0' ) ]
+
+	def _save( self, path, stat, chunks, complete ):
+		with self.lock:
+			self.conn.execute( 'DELETE FROM chunks WHERE path = ?', ( path, ) )
+			self.conn.executemany( 'INSERT INTO chunks VALUES ( ?, ?, ?, ? )', [ ( path, ) + tuple( c ) for c in chunks ] )
+			self.conn.execute( 'INSERT OR REPLACE INTO files VALUES ( ?, ?, ? )', ( path, pickle.dumps( stat ), int( complete ) ) )
+			if complete:
+				self.conn.execute( 'DELETE FROM stale WHERE path = ?', ( path, ) )
+			self.conn.commit()
+
+	def index( self, path, limit = None ):									# Куски файла; None, если файла нет или не уложились в limit байт
+		stat = fileutils.get_stat( path )
+		if stat == None:
+			self.forget( path )
+			return None
+		state = self.state( path )
+		if state != None and state[0] == stat and state[1]:
+			return self.chunks( path )
+		with self.lock:
+			if state != None and state[0] != stat:							# Файл изменился: его куски пригодятся для сверки
+				if state[1]:
+					self.conn.execute( 'DELETE FROM stale WHERE path = ?', ( path, ) )
+					self.conn.execute( 'INSERT INTO stale SELECT * FROM chunks WHERE path = ?', ( path, ) )
+				self.conn.execute( 'DELETE FROM chunks WHERE path = ?', ( path, ) )
+			done = self.chunks( path )										# Уже посчитанное при прерванном подсчёте
+			old = self.chunks( path, 'stale' )
+		try:
+			with open( path, 'rb' ) as f:
+				chunks, complete = self._update( path, stat, f, done, old, limit )
+		except ( PermissionError, FileNotFoundError ):
+			return None
+		if fileutils.get_stat( path ) != stat:								# Файл меняется прямо сейчас - досчитаем при следующем событии
+			self._save( path, None, chunks, False )
+			return None
+		self._save( path, stat, chunks, complete )
+		return chunks if complete else None
+
+	def _update( self, path, stat, f, chunks, old, limit ):					# Старые куски проверяются по хэшу, заново режется только изменившееся
+		if old and old[-1][1] < self.maxSize:								# Последний кусок мог быть обрезан концом файла - его граница ненадёжна
+			old = old[:-1]
+		after = { c[2]: i + 1 for i, c in enumerate( old ) }					# хэш куска -> какой старый кусок должен идти за ним
+		chunks = list( chunks )
+		offset = chunks[-1][0] + chunks[-1][1] if chunks else 0
+		i = after.get( chunks[-1][2] ) if chunks else 0
+		fresh, read = 0, 0
+		while offset < stat[0]:
+			while i != None and i < len( old ) and fileutils.digest_range( f, offset, old[i][1] ) == old[i][2]:
+				metrics.METRICS.count( 'chunk_verified_bytes', old[i][1] )
+				chunks.append( ( offset, old[i][1], old[i][2] ) )
+				offset += old[i][1]
+				read += old[i][1]
+				i += 1
+				if limit != None and read >= limit:
+					return chunks, offset >= stat[0]
+			i = None
+			for c in fileutils.iter_chunks( f, offset, self.bits, self.minSize, self.maxSize ):
+				metrics.METRICS.count( 'chunk_rolled_bytes', c[1] )
+				chunks.append( c )
+				offset = c[0] + c[1]
+				read += c[1]
+				fresh += 1
+				if limit != None and read >= limit:
+					return chunks, offset >= stat[0]
+				if fresh % self.SAVE_EVERY == 0:
+					self._save( path, stat, chunks, False )
+				i = after.get( c[2] )
+				if i != None:												# Кусок совпал со старым: дальше данные, скорее всего, те же
+					break
+			else:
+				break
+		return chunks, True
+
+	def rename( self, old, new ):											# Файл или папка целиком: куски остаются, пересчитывать нечего
+		with self.lock:
+			for table in ( 'files', 'chunks', 'stale' ):
+				self.conn.execute( 'UPDATE {0} SET path = ? || substr( path, ? ) WHERE path = ? OR substr( path, 1, ? ) = ?'.format( table ),
+								   ( new, len( old ) + 1, old, len( old ) + 1, os.path.join( old, '' ) ) )
+			self.conn.commit()
+
+	def forget( self, path ):
+		with self.lock:
+			for table in ( 'files', 'chunks', 'stale' ):
+				self.conn.execute( 'DELETE FROM {0} WHERE path = ?'.format( table ), ( path, ) )
+			self.conn.commit()
+
+	def shared( self, path ):												# [ ( другой файл, доля общих байт от размера path ) ] по убыванию доли
+		with self.lock:
+			total = self.conn.execute( 'SELECT SUM( length ) FROM chunks WHERE path = ?', ( path, ) ).fetchone()[0]
+			if not total:
+				return []
+			rows = self.conn.execute( '''
+				SELECT other.path, SUM( mine.length ) FROM
+					( SELECT DISTINCT digest, length FROM chunks WHERE path = ? ) AS mine
+					JOIN ( SELECT DISTINCT path, digest FROM chunks WHERE path != ? ) AS other ON other.digest = mine.digest
+				GROUP BY other.path''', ( path, path ) ).fetchall()
+		return sorted( ( ( p, n / total ) for p, n in rows ), key = lambda r: ( -r[1], r[0] ) )
+
+	def close( self ):
+		with self.lock:
+			self.conn.commit()
+			self.conn.close()
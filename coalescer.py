@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import fileutils
+
+class Coalescer:															# Склеивает события по пути и отдаёт их, когда файл перестал меняться
+	CREATED		= 'created'
+	MODIFIED	= 'modified'
+	DELETED		= 'deleted'
+	MOVED		= 'moved'
+	KINDS = ( CREATED, MODIFIED, DELETED, MOVED )
+	DEFAULT_QUIET = 1.0
+
+	def __init__( self, callback, quiet = None, clock = time.monotonic ):
+		self.callback = callback											# callback( kind, path, info )
+		self.quiet = quiet if quiet != None else self.DEFAULT_QUIET
+		self.clock = clock
+		self.pending = {}													# путь -> { kind, src, dirty, stat, deadline }
+		self.cond = threading.Condition()
+		self.thread = None
+		self.running = False
+
+	def push( self, kind, path, dest = None ):
+		with self.cond:
+			old = self.pending.pop( path, None )
+			if kind == self.MOVED:
+				entry = self._moved( old, path )
+				self.pending.pop( dest, None )
+				path = dest
+			else:
+				entry = self._merge( old, kind )
+			if entry != None:
+				entry['stat'] = fileutils.get_stat( path )
+				entry['deadline'] = self.clock() + self.quiet
+				self.pending[path] = entry
+			self.cond.notify()
+
+	def _merge( self, old, kind ):
+		if old == None:
+			return { 'kind': kind, 'src': None, 'dirty': False }
+		if kind == self.DELETED:
+			if old['kind'] == self.CREATED:
+				return None													# Создали и сразу удалили - ничего не было
+			if old['kind'] == self.MOVED:
+				return { 'kind': self.DELETED, 'src': None, 'dirty': False, 'path': old['src'] }
+			return { 'kind': self.DELETED, 'src': None, 'dirty': False }
+		if old['kind'] == self.DELETED:
+			return { 'kind': self.MODIFIED, 'src': None, 'dirty': False }	# Файл заменили новым
+		if old['kind'] == self.MOVED:
+			old['dirty'] = True
+		return old
+
+	def _moved( self, old, path ):
+		if old == None or old['kind'] == self.MODIFIED:
+			return { 'kind': self.MOVED, 'src': path, 'dirty': old != None }
+		return old															# Новый файл или цепочка переименований: важен только исходный путь
+
+	def flush( self, now = None, force = False ):							# Отдаёт все успокоившиеся события, возвращает их количество
+		if now == None:
+			now = self.clock()
+		ready = []
+		with self.cond:
+			for path, entry in list( self.pending.items() ):
+				if not force and entry['deadline'] > now:
+					continue
+				st = fileutils.get_stat( path )
+				if not force and st != entry['stat']:						# Файл ещё пишется - ждём дальше
+					entry['stat'] = st
+					entry['deadline'] = now + self.quiet
+					continue
+				del self.pending[path]
+				ready.append( ( entry['deadline'], path, entry ) )
+		ready.sort( key = lambda x: x[0] )
+		for deadline, path, entry in ready:
+			if entry['kind'] == self.MOVED:
+				self.callback( self.MOVED, entry['src'], path )
+				if entry['dirty']:
+					self.callback( self.MODIFIED, path, None )
+			else:
+				self.callback( entry['kind'], entry.get( 'path', path ), None )
+		return len( ready )
+
+	def start( self ):
+		self.running = True
+		self.thread = threading.Thread( target = self._loop, daemon = True )
+		self.thread.start()
+
+	def stop( self ):
+		with self.cond:
+			self.running = False
+			self.cond.notify()
+		if self.thread != None:
+			self.thread.join()
+		self.flush( force = True )
+
+	def _loop( self ):
+		while True:
+			with self.cond:
+				if not self.running:
+					return
+				if self.pending:
+					timeout = max( 0, min( i['deadline'] for i in self.pending.values() ) - self.clock() )
+				else:
+					timeout = None
+				self.cond.wait( timeout )
+				if not self.running:
+					return
+			self.flush()
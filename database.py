@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
-import pickle
 import re
+import bisect
+import functools
 import os.path
+import collections
+import threading
+import tagquery
+import phash
+import metrics
 
-from fileutils import get_size, get_created, get_hash
+from copy import deepcopy
+
+from fileutils import get_size, get_created, get_hash, get_stat, get_sample_hash
+from storage import Storage, load_pickle, dump_pickle
+from record import Record, Directory
 
 class DataBase:
 	EMPTY_DB = { 'dir': 'WATCH_DIR',
@@ -12,47 +22,385 @@ class DataBase:
 				 'media': [] }
 
 	REQUIRED_FIELDS = { 'file' }
+	INDEXED_FIELDS = ( 'hash', 'size' )
+	NAME_FIELDS = ( 'file', 'dir' )										# Для них есть отсортированный индекс: '^префикс' - поиск по диапазону
+	REGEX_META = set( '.^$*+?{}[]\\|()' )
 	DEFAULT_NONE_ITEMS = [ 'url', 'google' ]							# TODO: Вроде в словарях можно сразу задавать все возможные ключи.
 
-	def __init__( self ):
-		pass
+	def __init__( self, storage = None, shared = None ):
+		if storage == None:
+			storage = Storage()
+		self.storage = storage
+		self.shared = shared												# Общий для нескольких баз индекс: поле -> значение -> базы, где оно есть
+		self.lock = threading.RLock()										# Все изменения базы идут по очереди
+		self.dirty = 0														# Изменённых записей со времени последнего снимка
+		self._cow = None													# Пока делается снимок: номер -> запись до изменения
+		self.db = deepcopy( self.EMPTY_DB )
+
+	@property
+	def db( self ):
+		return self._db
+
+	@db.setter
+	def db( self, db ):														# При любой подмене базы индексы строятся заново
+		with self.lock:
+			db['media'][:] = [ i if type( i ) is Record else Record( i ) for i in db['media'] ]
+			self._db = db
+			self._reindex()
 
-	def load_db( self, dbFile = None ):
+	def load_db( self, dbFile = None, legacy = True ):						# Сначала хранилище, старый pickle - только для импорта, если legacy
 		if dbFile == None:
 			dbFile = 'db'
+		db = self.storage.load()
+		if db == None:
+			db = load_pickle( dbFile ) if legacy else None
+			if db == None:
+				db = deepcopy( self.EMPTY_DB )
+			db['media'] = [ Record( i ) for i in db['media'] ]				# Хранилище запоминает объекты записей - они должны быть окончательными
+			self.storage.import_db( db )
+		self.db = db
+
+	def snapshot( self, chunk = 1000 ):									# Согласованная копия базы на момент вызова, блокировка - короткими кусками
+		with self.lock:
+			if self._cow != None:
+				raise RuntimeError( 'Снимок базы уже делается!' )
+			self._cow = {}
+			items = list( self._records.items() )
+			res = { k: deepcopy( v ) for k, v in self.db.items() if k != 'media' }
+			self.dirty = 0
+		media = []
 		try:
-			with open( dbFile, 'rb' ) as f:
-				self.db = pickle.load( f )
-		except FileNotFoundError:
-			self.db = self.EMPTY_DB
+			for i in range( 0, len( items ), chunk ):
+				with self.lock:
+					for rid, elem in items[i:i + chunk]:
+						media.append( self._cow.get( rid ) or dict( elem ) )
+		finally:
+			with self.lock:
+				self._cow = None
+		res['media'] = media
+		return res
 
-	def find( self, flags = {}, **pattern ):
-		res = []
-		for i in self.db['media']:
-			for k, v in pattern.items():
-				if k == 'tags':
-					if v < i['tags']:										# если v подмножество i['tags']
-						continue
-				elif flags.get( 're', False ) and type( v ) is str and i[k] != None:
-					#print( '[DEBUG]:', v, i[k], i, '[/DEBUG]' )
-					if re.search( v, i[k] ) != None:
-						continue
-				if i[k] != v:
+	def _preserve( self, rid, elem ):										# Запись вот-вот изменится - снимку нужна её старая версия
+		if self._cow != None and rid not in self._cow:
+			self._cow[rid] = dict( elem )
+
+	def dump_db( self, dbFile = None ):
+		if dbFile == None:
+			dbFile = 'db'
+		dump_pickle( dict( self.db, media = [ dict( i ) for i in self.db['media'] ] ), dbFile )	# Файл читается и без модуля record
+
+	def _reindex( self ):
+		if self.shared != None and hasattr( self, '_fieldIndex' ):
+			for k, index in self._fieldIndex.items():
+				for v in index:
+					self._unshare( k, v )
+		self._ids = {}														# id( элемента ) -> номер записи
+		self._records = {}													# номер записи -> элемент
+		self._nextId = 0
+		self._dirs = {}														# имя папки -> Directory, общий для всех её записей
+		self._pathIndex = {}												# ( Directory, file ) -> { номер: элемент }
+		self._fieldIndex = { k: {} for k in self.INDEXED_FIELDS }			# поле -> значение -> { номер: элемент }
+		self._tagIndex = {}													# тэг -> { номер: элемент }
+		self._similar = phash.BKTree()										# перцептивный хэш -> номера записей
+		self._nameIndex = { k: {} for k in self.NAME_FIELDS }				# имя -> { номер: элемент }
+		self._sortedNames = { k: None for k in self.NAME_FIELDS }			# Отсортированные имена, строятся при первом запросе
+		for elem in self.db['media']:
+			self._index( elem )
+
+	def _index( self, elem ):
+		rid = self._nextId
+		self._nextId += 1
+		self._ids[id( elem )] = rid
+		self._records[rid] = elem
+		self._link( rid, elem )
+
+	def _forget( self, elem ):
+		rid = self._ids.pop( id( elem ) )
+		del self._records[rid]
+		self._unlink( rid, elem )
+
+	def _link( self, rid, elem ):
+		self._pathIndex.setdefault( ( self._attach_dir( elem ), elem.get( 'file' ) ), {} )[rid] = elem
+		for k, index in self._fieldIndex.items():
+			v = elem.raw( k )												# Индекс хранит те же байты хэша, что и запись
+			if v not in index:
+				index[v] = {}
+				if self.shared != None:
+					self.shared.setdefault( k, {} ).setdefault( v, set() ).add( self )
+			index[v][rid] = elem
+		for t in elem.get( 'tags' ) or ():
+			self._tagIndex.setdefault( t, {} )[rid] = elem
+		if elem.get( 'phash' ) != None:
+			self._similar.add( elem['phash'], rid )
+		for k, index in self._nameIndex.items():
+			v = elem.get( k )
+			if v not in index:
+				index[v] = {}
+				if self._sortedNames[k] != None and type( v ) is str:
+					bisect.insort( self._sortedNames[k], v )
+			index[v][rid] = elem
+
+	def _unlink( self, rid, elem ):
+		keys = [ ( None, self._pathIndex, ( elem.raw( 'dir' ), elem.get( 'file' ) ) ) ]
+		keys += [ ( k, index, elem.raw( k ) ) for k, index in self._fieldIndex.items() ]
+		keys += [ ( None, self._tagIndex, t ) for t in elem.get( 'tags' ) or () ]
+		for field, index, key in keys:
+			bucket = index.get( key )
+			if bucket is not None:
+				bucket.pop( rid, None )
+				if not bucket:
+					del index[key]
+					if field != None and self.shared != None:
+						self._unshare( field, key )
+		for k, index in self._nameIndex.items():
+			v = elem.get( k )
+			bucket = index.get( v )
+			if bucket is not None:
+				bucket.pop( rid, None )
+				if not bucket:
+					del index[v]
+					names = self._sortedNames[k]
+					if names != None and type( v ) is str:
+						del names[bisect.bisect_left( names, v )]
+		if elem.get( 'phash' ) != None:
+			self._similar.remove( elem['phash'], rid )
+		self._detach_dir( elem )
+
+	def _attach_dir( self, elem ):											# Запись ссылается на общий объект папки
+		name = elem.get( 'dir' )
+		if type( name ) is not str:
+			return name
+		d = self._dirs.get( name )
+		if d == None:
+			d = self._dirs[name] = Directory( name )
+		d.count += 1
+		elem.dir = d
+		return d
+
+	def _detach_dir( self, elem ):
+		d = elem.raw( 'dir' )
+		if type( d ) is Directory:
+			d.count -= 1
+			if not d.count and self._dirs.get( d.name ) is d:
+				del self._dirs[d.name]
+
+	def _unshare( self, field, value ):
+		owners = self.shared.get( field, {} ).get( value )
+		if owners != None:
+			owners.discard( self )
+			if not owners:
+				del self.shared[field][value]
+
+	@staticmethod
+	@functools.lru_cache( maxsize = 256 )
+	def _regex( pattern ):													# Скомпилированная регулярка и её буквальный префикс после '^'
+		prefix = []
+		if pattern.startswith( '^' ) and '|' not in pattern:
+			i = 1
+			while i < len( pattern ):
+				c, step = pattern[i], 1
+				if c == '\\':
+					if i + 1 == len( pattern ) or pattern[i + 1].isalnum():	# \d, \w и т.п. - уже не буква
+						break
+					c, step = pattern[i + 1], 2
+				elif c in DataBase.REGEX_META:
 					break
-			else:
-				res.append( i )
-		return res
+				if pattern[i + step:i + step + 1] in ( '*', '?', '{' ):		# Символа может и не быть
+					break
+				prefix.append( c )
+				i += step
+		return re.compile( pattern ), ''.join( prefix )
+
+	def _names_with_prefix( self, k, prefix ):								# Поиск по диапазону в отсортированных именах
+		names = self._sortedNames[k]
+		if names == None:
+			names = self._sortedNames[k] = sorted( v for v in self._nameIndex[k] if type( v ) is str )
+		bucket = {}
+		for i in range( bisect.bisect_left( names, prefix ), len( names ) ):
+			if not names[i].startswith( prefix ):
+				break
+			bucket.update( self._nameIndex[k][names[i]] )
+		return bucket
+
+	def _candidates( self, flags, pattern ):								# Выбираем самый короткий список из подходящих индексов
+		isRe = flags.get( 're', False )
+		exact = lambda k: k in pattern and not ( isRe and type( pattern[k] ) is str )
+		buckets = []
+		if exact( 'file' ) and exact( 'dir' ):
+			buckets.append( self._pathIndex.get( ( self._dirs.get( pattern['dir'], pattern['dir'] ), pattern['file'] ), {} ) )
+		for k in self.NAME_FIELDS:
+			if exact( k ):
+				buckets.append( self._nameIndex[k].get( pattern[k], {} ) )
+			elif k in pattern and self._regex( pattern[k] )[1]:
+				buckets.append( self._names_with_prefix( k, self._regex( pattern[k] )[1] ) )
+		buckets += [ index.get( Record.encode( k, pattern[k] ), {} ) for k, index in self._fieldIndex.items() if exact( k ) ]
+		tags = pattern.get( 'tags' )
+		if isinstance( tags, ( set, frozenset ) ):
+			buckets += [ self._tagIndex.get( t, {} ) for t in tags ]
+		if not buckets:
+			return self.db['media']											# Регулярные выражения - только полный перебор
+		bucket = min( buckets, key = len )
+		return [ bucket[rid] for rid in sorted( bucket ) ]					# Сохраняем порядок добавления
+
+	@staticmethod
+	def _match( elem, pattern, compiled ):
+		for k, v in pattern.items():
+			if k == 'tags':
+				if v < elem['tags']:										# если v подмножество i['tags']
+					continue
+			elif k in compiled and elem[k] != None:
+				if compiled[k].search( elem[k] ) != None:
+					continue
+			if elem[k] != v:
+				return False
+		return True
+
+	def paths( self ):														# Все пары ( dir, file ), что есть в базе
+		with self.lock:
+			return [ ( getattr( d, 'name', d ), f ) for d, f in self._pathIndex ]
+
+	def find_similar( self, key, distance ):								# Картинки с перцептивным хэшем не дальше distance, ближние первыми
+		with self.lock:
+			return [ self._records[rid] for d, rid in self._similar.search( key, distance ) ]
+
+	def iter_find( self, flags = {}, **pattern ):							# Курсор: записи по одной, просмотр кончается на flags['limit'] найденных
+		compiled = {}														# Регулярки компилируются один раз на запрос ( и кэшируются )
+		if flags.get( 're', False ):
+			compiled = { k: self._regex( v )[0] for k, v in pattern.items() if type( v ) is str }
+		limit = flags.get( 'limit' )
+		with self.lock:
+			candidates = self._candidates( flags, pattern )
+			if candidates is self.db['media']:								# Снимок: база может меняться, пока курсор читают
+				candidates = list( candidates )
+		scanned = found = 0
+		try:
+			for i in candidates:
+				if found == limit:
+					break
+				scanned += 1
+				if self._match( i, pattern, compiled ):
+					found += 1
+					yield i
+		finally:
+			metrics.METRICS.count( 'find_scanned', scanned )				# Сколько записей просмотрено ради найденных
+			metrics.METRICS.count( 'find_returned', found )
+
+	@metrics.timed( 'find' )
+	def find( self, flags = {}, **pattern ):								# flags = { 'limit': n } - не больше n записей
+		with self.lock:
+			return list( self.iter_find( flags, **pattern ) )
+
+	def first( self, flags = {}, **pattern ):								# Первая подходящая запись или None
+		with self.lock:
+			return next( self.iter_find( dict( flags, limit = 1 ), **pattern ), None )
+
+	def exists( self, flags = {}, **pattern ):
+		return self.first( flags, **pattern ) is not None
+
+	def count( self, flags = {}, **pattern ):								# Без списка найденных записей
+		with self.lock:
+			return sum( 1 for i in self.iter_find( flags, **pattern ) )
+
+	def query( self, expr ):												# Булев запрос по тэгам и полям, см. tagquery
+		tree = tagquery.parse( expr ) if isinstance( expr, str ) else expr
+		with self.lock:
+			return [ self._records[rid] for rid in sorted( self._eval( tree, None ) ) ]
+
+	def _estimate( self, node ):											# Примерный размер результата: счётчики тэгов и размеры индексов
+		kind = node[0]
+		if kind == 'tag':
+			return self.db['tags'].get( node[1], 0 )
+		if kind == 'field' and node[2] == '=' and node[1] in self._fieldIndex:
+			return len( self._fieldIndex[node[1]].get( Record.encode( node[1], node[3] ), () ) )
+		if kind == 'and':
+			return min( self._estimate( i ) for i in node[1] )
+		if kind == 'or':
+			return sum( self._estimate( i ) for i in node[1] )
+		return len( self._records )											# Отрицание и перебор - в самом конце
+
+	def _eval( self, node, within ):										# Множество номеров записей; within - чем уже ограничен результат
+		kind = node[0]
+		if kind == 'and':
+			for i in sorted( node[1], key = self._estimate ):				# Начинаем с самого короткого списка
+				within = self._eval( i, within )
+				if not within:
+					break
+			return within
+		if kind == 'or':
+			res = set()
+			for i in node[1]:
+				res |= self._eval( i, within )
+			return res
+		pool = self._records.keys() if within == None else within
+		if kind == 'not':
+			return set( pool ) - self._eval( node[1], within )
+		if kind == 'tag':
+			postings = self._tagIndex.get( node[1], {} )
+		elif node[2] == '=' and node[1] in self._fieldIndex:
+			postings = self._fieldIndex[node[1]].get( Record.encode( node[1], node[3] ), {} )
+		else:
+			return { rid for rid in pool if self._test( self._records[rid], *node[1:] ) }
+		if within == None:
+			return set( postings )
+		if len( postings ) < len( within ):
+			return { rid for rid in postings if rid in within }
+		return { rid for rid in within if rid in postings }
+
+	@staticmethod
+	def _test( elem, k, op, v ):
+		value = elem.get( k )
+		if op == '~':
+			return type( value ) is str and DataBase._regex( v )[0].search( value ) != None
+		if op == '=':
+			return value == v
+		try:
+			return value < v if op == '<' else value > v
+		except TypeError:													# None или несравнимые типы
+			return False
 
 	def update( self, search_data, update_data ):
 		if not search_data.get( 'dir' ):
 			search_data['dir'] = ''
-		for elem in self.find( **search_data ):
-			elem.update( update_data )
-		#print( 'DB_UPDATE:', 'In', search_data, 'Data:', update_data )
+		with self.lock, self.storage.transaction():						# Все изменённые записи - одним коммитом
+			for elem in self.find( **search_data ):
+				rid = self._ids[id( elem )]
+				self._preserve( rid, elem )
+				self.dirty += 1
+				self._unlink( rid, elem )
+				elem.update( update_data )
+				self._link( rid, elem )
+				self.storage.update( elem )
+
+	def rename_dir( self, old, new ):										# Переименование папки без перебора её записей
+		with self.lock, self.storage.transaction():
+			d = self._dirs.get( old )
+			if d == None or old == new:
+				return 0
+			if new in self._dirs:											# Слияние с уже известной папкой - по записям
+				count = d.count
+				self.update( { 'dir': old }, { 'dir': new } )
+				return count
+			for rid, elem in self._nameIndex['dir'][old].items():			# Имя папки общее, и снимку нужно старое
+				self._preserve( rid, elem )
+			self.dirty += d.count
+			del self._dirs[old]
+			d.name = new
+			self._dirs[new] = d
+			index = self._nameIndex['dir']
+			index[new] = index.pop( old )
+			names = self._sortedNames['dir']
+			if names != None:
+				del names[bisect.bisect_left( names, old )]
+				bisect.insort( names, new )
+			self.storage.rename_dir( old, new )
+			return d.count
+
+	def update_many( self, changes ):										# changes - пары ( search_data, update_data ), всё одной транзакцией
+		with self.lock, self.storage.transaction():
+			for search_data, update_data in changes:
+				self.update( search_data, update_data )
 
-	def add( self, **data ):
-		if not self.REQUIRED_FIELDS < set( data.keys() ) and set( data.keys() ) != self.REQUIRED_FIELDS:
-			raise NameError( 'Обязательные аргументы не были переданы! Нужны как минимум: ' + ','.join( self.REQUIRED_FIELDS ) )
+	def _prepare( self, data, flags ):										# Всё чтение с диска - до блокировки базы
 		if not data.get( 'dir' ):
 			data['dir'] = ''
 		f = os.path.join( self.db['dir'], data['dir'], data['file'] )
@@ -60,24 +408,105 @@ class DataBase:
 			data['size'] = get_size( f )
 		if not data.get( 'created' ):
 			data['created'] = get_created( f )
-		if not data.get( 'hash' ):
+		for k, func in ( ( 'stat', get_stat ), ( 'sample', get_sample_hash ) ):	# Подпись снимается до хэширования
+			if not data.get( k ):
+				v = func( f )
+				if v:
+					data[k] = v
+				else:
+					data.pop( k, None )
+		if not data.get( 'hash' ) and not flags.get( 'lazy', False ):
 			data['hash'] = get_hash( f )
+		data['hash'] = data.get( 'hash' )
 		if not data.get( 'tags' ):
 			data['tags'] = { 'Unsorted' }
-		for t in data['tags']:									
-			self.db['tags'][t] = self.db['tags'].get( t, 0 ) + 1	# TODO: Использовать здесь defaultdict
 		for i in self.DEFAULT_NONE_ITEMS:
 			data[i] = data.get( i )
-		#print( 'DB_ADD:', data )
-		self.db['media'].append( data )
+		return data
+
+	def add( self, flags = {}, **data ):									# flags = { 'lazy': True } - не считать хэш, его заполнят позже
+		self.add_many( [ data ], flags )
+
+	def add_many( self, records, flags = {} ):
+		required = self.REQUIRED_FIELDS
+		prepared = []
+		for data in records:
+			if not required <= data.keys():
+				raise NameError( 'Обязательные аргументы не были переданы! Нужны как минимум: ' + ','.join( required ) )
+			prepared.append( Record( self._prepare( dict( data ), flags ) ) )
+		images = [ data for data in prepared if 'phash' not in data ]		# Перцептивные хэши - одной пачкой
+		paths = [ os.path.join( self.db['dir'], data['dir'], data['file'] ) for data in images ]
+		for data, ( ph, resolution ) in zip( images, phash.hash_many( paths ) ):
+			if ph != None:
+				data['phash'] = ph
+				data['resolution'] = resolution
+		counts = collections.Counter( t for data in prepared for t in data['tags'] )
+		with self.lock, self.storage.transaction():
+			tags = self.db['tags']
+			for t, c in counts.items():
+				tags[t] = tags.get( t, 0 ) + c
+			self.db['media'].extend( prepared )
+			self.dirty += len( prepared )
+			for data in prepared:
+				self._index( data )
+				self.storage.add( data )
+		return len( prepared )
 
 	def remove( self, **pattern ):
-		for i, v in enumerate( self.db['media'].copy() ):				# TODO: Найти способ избежать копирования массива
-			if v in self.find( **pattern ):
-				self.db['media'].pop( i )
-				for t in v['tags']:
-					count = self.db['tags'][t] - 1
-					if count == 0:
-						del self.db['tags'][t]							# TODO: Использовать defaultdict !!!
-					else:
-						self.db['tags'][t] = count
+		return self.remove_many( [ pattern ] )
+
+	def remove_many( self, patterns ):										# Удаляет за один проход всё, что подошло хотя бы под один шаблон
+		with self.lock, self.storage.transaction():
+			doomed = {}
+			for pattern in patterns:
+				for elem in self.find( **pattern ):
+					doomed[self._ids[id( elem )]] = elem
+			if not doomed:
+				return 0
+			self.db['media'][:] = [ i for i in self.db['media'] if self._ids[id( i )] not in doomed ]
+			self.storage.remove( doomed.values() )
+			self.dirty += len( doomed )
+			tags = self.db['tags']
+			touched = set()
+			for elem in doomed.values():
+				self._forget( elem )
+				for t in elem['tags']:
+					if t in tags:
+						tags[t] -= 1
+						touched.add( t )
+			for t in touched:
+				if tags[t] <= 0:
+					del tags[t]
+			return len( doomed )
+
+
+
+class ShardedDataBase:														# Несколько баз ( по одной на корень ) с общим индексом хэшей и размеров
+	def __init__( self ):
+		self.shards = []
+		self.shared = {}
+
+	def new_shard( self, storage = None ):
+		db = DataBase( storage, self.shared )
+		self.shards.append( db )
+		return db
+
+	def _owners( self, flags, pattern ):									# По точному хэшу или размеру опрашиваем только базы, где он есть
+		isRe = flags.get( 're', False )
+		owners = None
+		for k in DataBase.INDEXED_FIELDS:
+			if k in pattern and not ( isRe and type( pattern[k] ) is str ):
+				found = self.shared.get( k, {} ).get( Record.encode( k, pattern[k] ), set() )
+				owners = found if owners == None else owners & found
+		if owners == None:
+			return self.shards
+		return [ db for db in self.shards if db in owners ]
+
+	def find_in( self, flags = {}, **pattern ):								# [ ( база, запись ) ] из всех баз, в порядке их подключения
+		return [ ( db, i ) for db in self._owners( flags, pattern ) for i in db.find( flags, **pattern ) ]
+
+	def find( self, flags = {}, **pattern ):
+		return [ i for db, i in self.find_in( flags, **pattern ) ]
+
+	def find_similar( self, key, distance ):
+		return [ i for db in self.shards for i in db.find_similar( key, distance ) ]
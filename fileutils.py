@@ -1,22 +1,62 @@
 #!/usr/bin/env python3
 
 import os.path
+import random
 import hashlib
-import time
-
-def wait_for_file( f ):
-	def wrapper( *args, **kwargs ):
-		res = None
-		for i in range( 10 ):
-			res = f( *args, **kwargs )
-			if res != None:
-				break
-			else:
-				time.sleep( 0.01 )
-		if i != 0:
-			print( i, f, args, kwargs )
-		return res
-	return wrapper
+import threading
+import metrics
+
+from contextlib import contextmanager
+
+try:
+	import xxhash													# Необязательная зависимость для быстрых некриптографических хэшей
+except ImportError:
+	xxhash = None
+
+try:
+	import numpy													# Необязательная зависимость: быстрый поиск границ кусков
+except ImportError:
+	numpy = None
+
+DEFAULT_ALGORITHM = 'sha256'										# Хэши этим алгоритмом хранятся без префикса, как и раньше
+BUFFER_SIZE = 2**20
+SAMPLE_SIZE = 2**16
+CHUNK_BITS = 20														# Граница в среднем через 1 МБ после минимума
+CHUNK_MIN = 2**18
+CHUNK_MAX = 2**22
+CHUNK_WINDOW = 64
+_GEAR_NP = None
+
+def _gear_table( seed ):											# Одна и та же таблица при каждом запуске - иначе индекс кусков не переиспользовать
+	rnd = random.Random( seed )
+	return [ rnd.getrandbits( 32 ) for i in range( 256 ) ]
+
+_GEAR = _gear_table( 0x6765617220 )
+
+def _gear_np():
+	global _GEAR_NP
+	_GEAR_NP = numpy.array( _GEAR, dtype = numpy.uint64 )
+	return _GEAR_NP
+
+_local = threading.local()											# У каждого потока свой буфер для чтения
+
+def set_thread_bucket( bucket ):									# Ограничение скорости чтения для текущего потока, например throttle.TokenBucket
+	previous = getattr( _local, 'bucket', None )
+	_local.bucket = bucket
+	return previous
+
+@contextmanager
+def throttled( bucket ):
+	previous = set_thread_bucket( bucket )
+	try:
+		yield
+	finally:
+		set_thread_bucket( previous )
+
+def throttle( n ):													# Вызывается после каждого прочитанного блока
+	bucket = getattr( _local, 'bucket', None )
+	if bucket != None:
+		bucket.take( n )
 
 def get_file_and_dir( path, root, is_dir = False ):
 	path = os.path.normpath( path )
@@ -28,31 +68,141 @@ def get_file_and_dir( path, root, is_dir = False ):
 	head, directory = os.path.split( head )
 	return fileName, directory
 
-#@wait_for_file
 def get_size( fileName ):
 	try:
 		return os.path.getsize( fileName )
 	except FileNotFoundError:
 		return None
 
-#@wait_for_file
 def get_created( fileName ):
 	try:
 		return int( os.path.getctime( fileName ) )
 	except FileNotFoundError:
 		return None
 
-#@wait_for_file
-def get_hash( fileName ):
-	m = hashlib.sha256()
+def stat_signature( st ):
+	return ( st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev )
+
+def get_stat( fileName ):											# Подпись файла: если она не изменилась, то и хэш пересчитывать не нужно
 	try:
-		with open( fileName, "rb" ) as f:
+		return stat_signature( os.stat( fileName ) )
+	except FileNotFoundError:
+		return None
+
+def scan_tree( path, depth, skip = None ):							# Отдаёт ( DirEntry, уровень ) по мере обхода, глубже depth не заходит
+	stack = [ ( path, 1 ) ]
+	while stack:
+		directory, level = stack.pop()
+		try:
+			with os.scandir( directory ) as it:
+				entries = list( it )
+		except OSError:
+			continue
+		for entry in entries:
+			yield entry, level
+			if level < depth and entry.is_dir() and not ( skip and skip( entry ) ):	# По ссылкам на папки тоже заходим, глубина ограничена
+				stack.append( ( entry.path, level + 1 ) )
+
+def get_sample_hash( fileName ):									# Дешёвый хэш от размера, начала и конца файла
+	try:
+		with open( fileName, 'rb' ) as f:
+			size = os.fstat( f.fileno() ).st_size
+			m = hashlib.blake2b( str( size ).encode(), digest_size = 16 )
+			m.update( f.read( SAMPLE_SIZE ) )
+			if size > SAMPLE_SIZE:
+				f.seek( max( SAMPLE_SIZE, size - SAMPLE_SIZE ) )
+				m.update( f.read( SAMPLE_SIZE ) )
+		return m.hexdigest()
+	except ( PermissionError, FileNotFoundError ):
+		return None
+
+def digest_range( f, offset, length ):								# blake2b куска файла
+	m = hashlib.blake2b( digest_size = 16 )
+	f.seek( offset )
+	while length > 0:
+		data = f.read( min( length, BUFFER_SIZE ) )
+		if not data:
+			return None
+		throttle( len( data ) )
+		m.update( data )
+		length -= len( data )
+	return m.hexdigest()
+
+def _find_cut( data, start, stop, mask ):							# Первая позиция p в [start, stop), где сумма gear по data[p-W:p] делится на маску
+	if numpy != None:
+		table = _GEAR_NP if _GEAR_NP is not None else _gear_np()
+		for lo in range( start, stop, BUFFER_SIZE ):					# Кусками, чтобы не считать всё окно до максимума
+			hi = min( stop, lo + BUFFER_SIZE )
+			sums = numpy.cumsum( table[numpy.frombuffer( data, numpy.uint8, hi - lo + CHUNK_WINDOW - 1, lo - CHUNK_WINDOW )], dtype = numpy.uint64 )
+			sums = numpy.concatenate( ( sums[CHUNK_WINDOW - 1:CHUNK_WINDOW], sums[CHUNK_WINDOW:] - sums[:-CHUNK_WINDOW] ) )
+			hits = numpy.flatnonzero( ( sums & numpy.uint64( mask ) ) == 0 )
+			if hits.size:
+				return lo + int( hits[0] )
+		return None
+	gear = _GEAR
+	s = sum( gear[b] for b in data[start - CHUNK_WINDOW:start] )
+	for p in range( start, stop ):
+		if p > start:
+			s += gear[data[p - 1]] - gear[data[p - 1 - CHUNK_WINDOW]]
+		if not s & mask:
+			return p
+	return None
+
+def iter_chunks( f, offset = 0, bits = CHUNK_BITS, minSize = CHUNK_MIN, maxSize = CHUNK_MAX ):	# Куски с границами по содержимому: ( смещение, длина, хэш )
+	mask = ( 1 << bits ) - 1											# Граница зависит только от последних CHUNK_WINDOW байт, а не от начала куска
+	f.seek( offset )
+	buf, eof = b'', False
+	while True:
+		if not eof and len( buf ) < maxSize:
+			data = f.read( max( BUFFER_SIZE, maxSize - len( buf ) ) )
+			eof = not data
+			throttle( len( data ) )
+			buf += data
+			continue
+		if not buf:
+			return
+		cut = None
+		if len( buf ) > minSize:
+			cut = _find_cut( buf, minSize, min( len( buf ), maxSize ), mask )
+		if cut == None:
+			cut = min( len( buf ), maxSize )
+		yield offset, cut, hashlib.blake2b( buf[:cut], digest_size = 16 ).hexdigest()
+		offset += cut
+		buf = buf[cut:]
+
+def new_hasher( algorithm ):
+	if algorithm.startswith( 'xxh' ):
+		if xxhash == None:
+			raise ValueError( 'Для алгоритма {0} нужен модуль xxhash!'.format( algorithm ) )
+		return getattr( xxhash, algorithm )()
+	return hashlib.new( algorithm )
+
+def hash_algorithm( fileHash ):										# Алгоритм, которым был посчитан хэш из базы
+	if fileHash and ':' in fileHash:
+		return fileHash.split( ':', 1 )[0]
+	return DEFAULT_ALGORITHM
+
+@metrics.timed( 'hash' )
+def get_hash( fileName, algorithm = DEFAULT_ALGORITHM ):
+	m = new_hasher( algorithm )
+	view = getattr( _local, 'view', None )
+	if view == None:
+		view = _local.view = memoryview( bytearray( BUFFER_SIZE ) )
+	read = 0
+	try:
+		with open( fileName, "rb", buffering = 0 ) as f:
 			while True:
-				data = f.read( 4096 )
-				if data:
-					m.update( data )
+				n = f.readinto( view )
+				if n:
+					m.update( view[:n] )
+					read += n
+					throttle( n )
 				else:
 					break
+	except OSError:													# Нет доступа, файл пропал, это папка или битая ссылка
+		return None
+	finally:
+		metrics.METRICS.count( 'hash_bytes', read )
+	if algorithm == DEFAULT_ALGORITHM:
 		return m.hexdigest()
-	except ( PermissionError, FileNotFoundError ):
-		return None
\ No newline at end of file
+	return algorithm + ':' + m.hexdigest()
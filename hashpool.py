@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import collections
+import concurrent.futures
+import fileutils
+
+class HashPool:
+	DEFAULT_WORKERS = 4
+	DEFAULT_MAX_BYTES = 256 * 2**20											# Сколько байт файлов может хэшироваться одновременно
+
+	def __init__( self, workers = None, maxBytes = None, maxPending = None, algorithm = fileutils.DEFAULT_ALGORITHM, func = None, initializer = None ):
+		if func == None:
+			func = lambda path: fileutils.get_hash( path, algorithm )
+		self.func = func
+		self.workers = workers or self.DEFAULT_WORKERS
+		self.maxBytes = maxBytes or self.DEFAULT_MAX_BYTES
+		self.maxPending = maxPending or self.workers * 4
+		self.initializer = initializer										# Вызывается в каждом потоке пула, например throttle.low_priority
+
+	def imap( self, items, key = lambda x: x ):								# Отдаёт ( item, func( путь ) ) в исходном порядке, key возвращает путь или None
+		pending = collections.deque()
+		inFlight = 0
+		with concurrent.futures.ThreadPoolExecutor( self.workers, initializer = self.initializer ) as pool:
+			for item in items:
+				path = key( item )
+				size = ( fileutils.get_size( path ) or 0 ) if path else 0
+				while pending and ( len( pending ) >= self.maxPending or inFlight + size > self.maxBytes ):
+					done, doneSize, future = pending.popleft()
+					inFlight -= doneSize
+					yield done, future.result() if future else None
+				pending.append( ( item, size, pool.submit( self.func, path ) if path else None ) )
+				inFlight += size
+			while pending:
+				done, doneSize, future = pending.popleft()
+				yield done, future.result() if future else None
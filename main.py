@@ -5,12 +5,23 @@ import os
 import watchdog.events
 import watchdog.observers
 import threading
+import sys
+import traceback
 import time
-import glob
-import queue
 import fileutils
+import phash
+import metrics
 
-from database import DataBase
+import hashlib
+
+from database import ShardedDataBase
+from storage import SqliteStorage, load_pickle
+from hashpool import HashPool
+from coalescer import Coalescer
+from snapshot import Snapshotter
+from chunkindex import ChunkIndex
+from throttle import TokenBucket, low_priority
+from workqueue import WorkQueue
 
 class Event:
 	class ACTION:
@@ -32,6 +43,9 @@ class Event:
 		self.watchdir = watchdir
 		self.info = info
 		self.isInDB = False
+		self.stat = None													# Подпись файла, снятая до хэширования
+		self.image = None													# ( перцептивный хэш, разрешение ) для картинок
+		self.similar = None													# Похожие картинки из базы для SIMILAR и FOUND_BETTER
 	def __eq__( self, other ):
 		if self.action == other.action and self.fileName == other.fileName and self.isDir == other.isDir:
 		   if self.directory == other.directory and self.watchdir == other.watchdir and self.info == other.info:
@@ -50,16 +64,54 @@ class Engine( watchdog.events.FileSystemEventHandler ):
 	#DEFAULT_CFG = [r'D:\disk\Projects\pyMediaMonitor\WATCH_DIR']
 	DEFAULT_CFG = [r'D:\disk\Pictures\ponies']
 	DEFAULT_CFG_NAME = 'cfg'
+	DEFAULT_DB_NAME = 'db.sqlite'
+	SNAPSHOT_NAME = '{0}.snapshot'												# Резервная копия базы в pickle рядом с файлом SQLite
+	SNAPSHOT_INTERVAL = 300.0													# Не реже, чем раз в столько секунд, если база менялась
+	SNAPSHOT_DIRTY = 10000														# Или сразу, как изменилось столько записей
+	CHUNK_INDEX = False															# Хэши кусков больших файлов: частичные дубликаты и дешёвый пересчёт изменённых
+	CHUNK_INDEX_NAME = '{0}.chunks'
+	CHUNK_MIN_FILE = 64 * 2**20													# Файлы меньше этого целиком перехэшировать дешевле
+	CHUNK_STEP = 64 * 2**20														# Прогресс сохраняется через столько байт, между шагами проверяется остановка
+	RECONCILE_CHECKPOINT = 'reconcile.ckpt'
+	CHECKPOINT_EVERY = 100														# Через сколько папок сохранять прогресс сверки
+	HASH_WORKERS = 4
+	HASH_MAX_BYTES = 256 * 2**20
+	HASH_ALGORITHM = fileutils.DEFAULT_ALGORITHM								# Например 'blake2b' или 'xxh3_64' ( нужен xxhash )
+	QUEUE_SIZE = 10000
+	BACKGROUND_RATE = None														# Байт в секунду на фоновое чтение ( пересканирование, сверка, куски ), None - без ограничения
+	BACKGROUND_BURST = 64 * 2**20
+	BACKGROUND_LOW_PRIORITY = True												# Фоновые потоки с nice 19 и ionice idle ( Linux )
+	PAGE_SIZE = 1000															# Результат задания 'query' отдаётся страницами такого размера
+	SCAN_DEPTH = 2																# Ожидаемая структура: корень / папка / файл
+	SKIP_UNCHANGED_DIRS = False													# Не заходить в папки, mtime которых не менялся ( изменения внутри файлов не видны )
+	SIMILAR_DISTANCE = 10														# Сколько из 64 бит перцептивного хэша могут отличаться у похожих картинок
+	EVENT_QUIET = 1.0															# Сколько секунд файл не должен меняться, прежде чем его обработать
+	SETTLED_ACTIONS = { Coalescer.CREATED: Event.ACTION.NEW,
+						Coalescer.DELETED: Event.ACTION.MISSING,
+						Coalescer.MOVED: Event.ACTION.RENAMED,
+						Coalescer.MODIFIED: Event.ACTION.UPDATED }
 
-	def __init__( self, outFunc = None ):
+	def __init__( self, outFunc = None, shards = None, bucket = None ):	# shards - общие базы всех корней, для поиска дубликатов между ними; bucket - общий бюджет диска
 		watchdog.events.FileSystemEventHandler.__init__( self )
 		if not outFunc:
 			outFunc = lambda x: True
 		self.outFunc = outFunc
 		self.ignoreFiles = []
-		self.db = DataBase()
-		self.queue = queue.Queue()
-		self.worker = threading.Thread( target = self.worker )
+		self.shards = shards if shards != None else ShardedDataBase()
+		self.db = self.shards.new_shard()
+		self.hashAlgorithm = self.HASH_ALGORITHM
+		self.bucket = bucket if bucket != None else TokenBucket( self.BACKGROUND_RATE, self.BACKGROUND_BURST )
+		self.hashPool = HashPool( self.HASH_WORKERS, self.HASH_MAX_BYTES, func = self.statAndHash, initializer = self.backgroundThread )
+		self.hashed = {}													# Хэши, посчитанные пулом заранее: путь -> ( подпись, хэш )
+		self.coalescer = Coalescer( self.onSettled, self.EVENT_QUIET )
+		self.dirMtimes = {}													# Папка -> mtime на момент прошлого обхода
+		self.queue = WorkQueue( self.QUEUE_SIZE )
+		self.listeners = []													# Вызываются в обработчике с каждым применённым событием
+		self.chunks = None
+		self.chunkQueue = WorkQueue()										# Куски считаются в своём потоке, чтобы не задерживать события
+		self.chunker = threading.Thread( target = self.chunkWorker )
+		self.stopping = False
+		self.worker = threading.Thread( target = self.worker )			# Один обработчик: события одного файла не обгоняют друг друга
 
 	def setNotifyOnChange( self, path, isRecursive = False ):
 		self.observer = watchdog.observers.Observer()
@@ -81,22 +133,54 @@ class Engine( watchdog.events.FileSystemEventHandler ):
 		with open( cfgName, 'wb' ) as f:
 			pickle.dump( self.cfg, f )
 
-	def run( self ):
-		self.loadCfg()
-		self.db.load_db()
+	def start( self, dbFile = None, legacy = True ):						# legacy - импортировать ли старую базу-pickle, если хранилище пустое
+		dbFile = dbFile or self.DEFAULT_DB_NAME
+		self.db.storage = SqliteStorage( dbFile )
+		self.db.load_db( legacy = legacy )
+		self.db.db['dir'] = self.cfg[0]
+		self.snapshotter = Snapshotter( self.db, self.SNAPSHOT_NAME.format( dbFile ), self.SNAPSHOT_INTERVAL, self.SNAPSHOT_DIRTY )
+		self.snapshotter.start()
+		if self.CHUNK_INDEX:
+			self.chunks = ChunkIndex( self.CHUNK_INDEX_NAME.format( dbFile ) )
+			for path in self.chunks.pending():								# Подсчёт, прерванный при прошлом запуске
+				self.chunkQueue.put( ( 'chunk', path ) )
+			self.chunker.start()
+		self.coalescer.start()
 		self.setNotifyOnChange( self.cfg[0], True )
 		self.worker.start()
-		try:
-			while True:
-				inp = input()
-				if inp == 'd':
-					print( self.db.db )
-				elif inp == 'u':
-					self.updateAllInPath( self.cfg[0], self.cfg[0] )
-				time.sleep( 0.5 )
-		except KeyboardInterrupt:
-			self.queue.put( 'quit' )
-			self.worker.join()
+
+	def command( self, inp ):
+		if inp == 'd':
+			print( self.db.db )
+		elif inp == 'q':
+			print( self.queue.stats() )
+
+		elif inp == 'u':
+			self.updateAllInPath( self.cfg[0], self.cfg[0] )
+		elif inp == 'v':
+			self.updateAllInPath( self.cfg[0], self.cfg[0], True )
+		elif inp == 'r':
+			self.reconcile( self.cfg[0] )
+		elif inp == 's':
+			self.snapshotter.trigger()
+
+	def stop( self ):
+		self.observer.stop()
+		self.observer.join()
+		self.coalescer.stop()
+		self.stopping = True												# Недосчитанные куски продолжатся при следующем запуске
+		self.queue.put( 'quit' )
+		self.worker.join()
+		self.snapshotter.stop()
+		if self.chunks != None:
+			self.chunkQueue.put( 'quit' )
+			self.chunker.join()
+			self.chunks.close()
+		self.db.storage.close()
+
+	def run( self ):
+		self.loadCfg()
+		Monitor( self.cfg, self.outFunc ).run()
 
 	def worker( self ):
 		while True:
@@ -115,53 +199,305 @@ class Engine( watchdog.events.FileSystemEventHandler ):
 			if func == None:
 				func = lambda x: None
 
-			if task == 'query':
-				func( self.db.find( **query ) )
+			try:																# Ошибка одного задания не должна останавливать обработчик
+				if task == 'query':												# Строка - булев запрос по тэгам, словарь - шаблон find
+					self.sendPages( self.db.query( query ) if isinstance( query, str ) else self.db.iter_find( **query ), func )
+				elif task == 'hash':
+					func( self.fillHashes( **query ) )
+				elif task in ( 'event', 'rescan' ):
+					func( self.processEvent( self.prepareEvent( *query ) ) )
+				elif task == 'process':											# Событие уже разобрано, осталось применить
+					func( self.processEvent( query ) )
+				elif task == 'call':											# Произвольная работа с базой в потоке обработчика
+					func( query() )
+			except Exception:
+				print( 'Ошибка в задании {0} {1}:'.format( task, query ), file = sys.stderr )
+				traceback.print_exc()
+
+	def backgroundThread( self ):											# Потоки пересканирования и кусков: низкий приоритет и общий бюджет чтения
+		if self.BACKGROUND_LOW_PRIORITY:
+			low_priority()
+		fileutils.set_thread_bucket( self.bucket )
+
+	def chunkWorker( self ):												# Фоновый поток: индекс кусков с низким приоритетом и в общем бюджете диска
+		self.backgroundThread()
+		while True:
+			o = self.chunkQueue.get( True )
+			if isinstance( o, str ) and o == 'quit':
+				break
+			path = o[1]
+			try:
+				while not self.stopping and self.chunks.index( path, self.CHUNK_STEP ) == None and self.chunks.unfinished( path ):
+					pass														# Между шагами проверяется, не пора ли остановиться
+			except Exception:
+				print( 'Ошибка при подсчёте кусков {0}:'.format( path ), file = sys.stderr )
+				traceback.print_exc()
+
+	def sendPages( self, results, func ):									# func вызывается на каждую страницу, последняя - короче PAGE_SIZE ( или пустая )
+		page = []
+		for i in results:
+			page.append( i )
+			if len( page ) == self.PAGE_SIZE:
+				func( page )
+				page = []
+		func( page )
 
 	def addTask( self, task, resultFunc, **data ):
 		self.queue.put( ( task, resultFunc, data ) )
 
-	def updateAllInPath( self, path, root ):
-		path = os.path.join( path, '*' )
-		for f1 in glob.iglob( path ):
-			if os.path.isdir( f1 ):
-				path2 = os.path.join( f1, '*' )
-				for f2 in glob.iglob( path2 ):
-					if os.path.isdir( f2 ):
-						self.processEvent( self.prepareEvent( f2, root, Event.ACTION.BROKEN_STRUCTURE ) )
-					else:
-						self.processEvent( self.prepareEvent( f2, root, Event.ACTION.NEW ) )
+	def walkPath( self, path, depth = None, skipUnchanged = False ):		# Отдаёт ( путь, действие, папка ли, подпись файла )
+		if depth == None:
+			depth = self.SCAN_DEPTH
+		skip = self.dirUnchanged if skipUnchanged else None
+		for entry, level in fileutils.scan_tree( path, depth, skip ):
+			if entry.is_dir():												# Ссылка на папку - папка, как у os.path.isdir
+				if level == depth:
+					yield entry.path, Event.ACTION.BROKEN_STRUCTURE, True, None
+				continue
+			try:
+				st = fileutils.stat_signature( entry.stat() )
+			except OSError:													# Битая ссылка или нечитаемый файл - записывать нечего
+				continue
+			yield entry.path, Event.ACTION.NEW, False, st
+
+	def dirUnchanged( self, entry ):										# Папку не трогали со времени прошлого обхода
+		try:
+			mtime = entry.stat().st_mtime_ns
+		except OSError:
+			return False
+		unchanged = self.dirMtimes.get( entry.path ) == mtime
+		self.dirMtimes[entry.path] = mtime
+		return unchanged
+
+	def cachedHash( self, path, root, record = None, st = None ):			# Хэш из базы, если подпись файла не изменилась
+		if record == None:
+			f, d = fileutils.get_file_and_dir( path, root )
+			res = self.db.find( flags = { 're': False, 'limit': 2 }, file = f, dir = d )	# Важно лишь, одна ли запись
+			if len( res ) != 1:
+				return None
+			record = res[0]
+		if st == None:
+			st = fileutils.get_stat( path )
+		if record.get( 'stat' ) != None and record['stat'] == st:
+			return record['hash']
+		return None
+
+	def statAndHash( self, path, algorithm = None ):						# Подпись снимается до чтения, чтобы не записать её к старому хэшу
+		st = fileutils.get_stat( path )
+		return st, fileutils.get_hash( path, algorithm or self.hashAlgorithm )
+
+	def fillHashes( self, **pattern ):										# Досчитывает хэши записей, добавленных без полного хэша
+		count = 0
+		for elem in self.db.find( hash = None, **pattern ):
+			st, f_hash = self.statAndHash( os.path.join( self.cfg[0], elem['dir'], elem['file'] ) )
+			if f_hash != None:
+				data = { 'hash': f_hash }
+				if st:
+					data['stat'] = st
+				self.db.update( { 'file': elem['file'], 'dir': elem['dir'] }, data )
+				count += 1
+		return count
+
+	def duplicateCandidates( self, path ):									# Дешёвые проверки: сначала размер, затем образец из начала и конца файла
+		same = self.shards.find_in( size = fileutils.get_size( path ) )	# Кандидаты ищутся во всех корнях
+		if not len( same ):
+			return []
+		sample = fileutils.get_sample_hash( path )
+		same = [ ( db, i ) for db, i in same if i.get( 'sample' ) in ( None, sample ) ]
+		for db, i in same:
+			if i['hash'] == None and db is self.db:							# Хэши чужих корней досчитывают их обработчики
+				self.fillHashes( file = i['file'], dir = i['dir'] )
+		return [ i for db, i in same if i['hash'] != None ]
+
+	def findDuplicates( self, path, f_stat, f_hash ):						# Файл хэшируется каждым алгоритмом, который есть у кандидатов
+		hashes = {}
+		if f_hash != None:
+			hashes[fileutils.hash_algorithm( f_hash )] = f_hash
+		for algorithm in { fileutils.hash_algorithm( i['hash'] ) for i in self.duplicateCandidates( path ) }:
+			if algorithm not in hashes:
+				st, hashes[algorithm] = self.statAndHash( path, algorithm )
+				if f_stat == None:
+					f_stat = st
+		res_hash = [ i for h in hashes.values() if h != None for i in self.shards.find( hash = h ) ]
+		if self.hashAlgorithm in hashes:
+			f_hash = hashes[self.hashAlgorithm]
+		elif hashes:
+			f_hash = next( iter( hashes.values() ) )
+		return f_stat, f_hash, res_hash										# Без хэша дубликат уже исключён по размеру или образцу
+
+	def updateAllInPath( self, path, root, verify = False ):				# Хэши считаются пулом, а события обрабатываются по порядку
+		def toHash( item ):
+			if item[1] != Event.ACTION.NEW or not verify and self.cachedHash( item[0], root, st = item[3] ) != None:
+				return None
+			return item[0]
+		items = self.walkPath( path, skipUnchanged = self.SKIP_UNCHANGED_DIRS and not verify )
+		for ( f, action, isDir, st ), res in self.hashPool.imap( items, toHash ):
+			if res != None and res[1] != None:
+				self.hashed[f] = res
+			self.queue.put( ( 'rescan', ( f, root, action, None, isDir ) ) )	# База меняется только в обработчике очереди
+
+	def loadCheckpoint( self, checkpoint, root ):
+		try:
+			with open( checkpoint, 'rb' ) as f:
+				state = pickle.load( f )
+			if state['root'] == root:
+				return state
+		except FileNotFoundError:
+			pass
+		return { 'root': root, 'done': None, 'new': [], 'missing': [] }
+
+	def saveCheckpoint( self, checkpoint, state ):
+		with open( checkpoint + '.tmp', 'wb' ) as f:
+			pickle.dump( state, f )
+		os.replace( checkpoint + '.tmp', checkpoint )
+
+	def listDir( self, root, d ):											# Файлы папки и вложенные папки; ( None, [] ), если папку прочитать не удалось
+		files, dirs = {}, []
+		try:
+			with os.scandir( os.path.join( root, d ) ) as it:
+				entries = list( it )
+		except FileNotFoundError:											# Папку удалили - её файлы действительно пропали
+			return files, dirs
+		except OSError:
+			return None, dirs
+		for entry in entries:
+			if entry.is_dir():												# Ссылки на папки - тоже папки, как у os.path.isdir
+				dirs.append( entry.name )
+				continue
+			try:
+				files[entry.name] = fileutils.stat_signature( entry.stat() )
+			except OSError:													# Битая ссылка или нечитаемый файл: есть, но подписи нет
+				files[entry.name] = None
+		return files, dirs
+
+	def reconcile( self, root, checkpoint = None ):							# Сверка базы с диском за один проход, прерванная сверка продолжается
+		if checkpoint == None:
+			checkpoint = self.RECONCILE_CHECKPOINT
+		state = self.loadCheckpoint( checkpoint, root )
+		byDir = {}
+		for d, f in self.db.paths():
+			byDir.setdefault( d, set() ).add( f )
+		if not os.path.isdir( root ):										# Корень не смонтирован - это не значит, что все файлы пропали
+			return 0
+		rootFiles, rootDirs = self.listDir( root, '' )
+		for n, d in enumerate( sorted( set( byDir ) | set( rootDirs ) | { '' } ) ):
+			if state['done'] != None and d <= state['done']:
+				continue
+			onDisk = rootFiles if d == '' else self.listDir( root, d )[0]
+			if onDisk == None:												# Папку не прочитать - её записи не трогаем
+				continue
+			known = byDir.get( d, set() )
+			state['new'] += [ ( d, f, st ) for f, st in sorted( onDisk.items() ) if f not in known and st != None ]
+			state['missing'] += [ ( d, f ) for f in sorted( known ) if f not in onDisk ]
+			state['done'] = d
+			if n % self.CHECKPOINT_EVERY == 0:
+				self.saveCheckpoint( checkpoint, state )
+		self.saveCheckpoint( checkpoint, state )
+		with fileutils.throttled( self.bucket ):							# Сверка - фоновая работа, её чтение тоже в бюджете
+			count = self.emitReconciled( root, state )
+		os.unlink( checkpoint )
+		return count
+
+	def emitReconciled( self, root, state ):								# Пропавшие и новые файлы с тем же inode или хэшем - переименования
+		missing, byInode = {}, {}
+		for d, f in state['missing']:
+			res = self.db.find( flags = { 're': False, 'limit': 2 }, file = f, dir = d )
+			if len( res ) == 1:
+				missing[( d, f )] = res[0]
+				if res[0].get( 'stat' ) and res[0]['stat'][2]:					# На некоторых ФС inode всегда 0
+					byInode[res[0]['stat'][2:]] = ( d, f )
+		count = 0
+		for d, f, st in state['new']:
+			path = os.path.join( root, d, f )
+			old = byInode.get( st[2:] )
+			if old not in missing:
+				old, hashes = None, {}
+				for key, record in missing.items():
+					if record['size'] == st[0] and record['hash'] != None:
+						algorithm = fileutils.hash_algorithm( record['hash'] )
+						if algorithm not in hashes:
+							hashes[algorithm] = fileutils.get_hash( path, algorithm )
+						if hashes[algorithm] == record['hash']:
+							old = key
+							break
+			if old != None:
+				del missing[old]
+				ev = Event( old[1], old[0], False, root, ( f, d ) )
+				ev.action = Event.ACTION.RENAMED
+				ev.isInDB = True
+				self.queue.put( ( 'process', ev ) )
 			else:
-				self.processEvent( self.prepareEvent( f1, root, Event.ACTION.NEW ) )
+				self.queue.put( ( 'rescan', ( path, root, Event.ACTION.NEW, None, False ) ) )
+			count += 1
+		for d, f in missing:
+			ev = Event( f, d, False, root )
+			ev.action = Event.ACTION.MISSING
+			ev.isInDB = True
+			self.queue.put( ( 'process', ev ) )
+			count += 1
+		return count
 
 	def processEvent( self, event ):
 		if event.action != Event.ACTION.NOT_PROCESSING and self.outFunc( event ):
-			if event.action == Event.ACTION.NEW:
-				self.db.add( file = event.fileName, dir = event.directory, hash = event.info )				# TODO: Делать запрос в гугл ( и другие операции )
+			if event.action in ( Event.ACTION.NEW, Event.ACTION.SIMILAR, Event.ACTION.FOUND_BETTER ):
+				lazy = event.info == None
+				image = { 'phash': event.image[0], 'resolution': event.image[1] } if event.image else {}
+				self.db.add( flags = { 'lazy': lazy }, file = event.fileName, dir = event.directory, hash = event.info,
+							 stat = event.stat, **image )																# TODO: Делать запрос в гугл ( и другие операции )
+				if lazy:
+					self.queue.put( ( 'hash', { 'file': event.fileName, 'dir': event.directory } ), force = True )
+				self.queueChunks( event.path )
 			elif event.action == Event.ACTION.MISSING:
 				self.db.remove( file = event.fileName, dir = event.directory )
+				if self.chunks != None:
+					self.chunks.forget( event.path )
 			elif event.action == Event.ACTION.DUPLICATE:
 				self.ignoreFiles.append( event.path )
 				os.unlink( event.path )
 			elif event.action == Event.ACTION.UPDATED:
-				self.db.update( { 'file': event.fileName, 'dir': event.directory },
-								{ 'hash': event.info } )
+				data = { 'hash': event.info }
+				if event.stat:
+					data['stat'] = event.stat
+				sample = fileutils.get_sample_hash( event.path )
+				if sample:
+					data['sample'] = sample
+				self.db.update( { 'file': event.fileName, 'dir': event.directory }, data )
+				self.queueChunks( event.path )
 			elif event.action == Event.ACTION.RENAMED:
 				if event.isDir:
-					self.db.update( { 'dir': event.directory },
-									{ 'dir': event.info[1] } )
+					self.db.rename_dir( event.directory, event.info[1] )
+					if self.chunks != None:
+						self.chunks.rename( os.path.join( event.watchdir, event.directory ), os.path.join( event.watchdir, event.info[1] ) )
 				else:
 					#self.ignoreFiles.append( event.info[0] )
 					self.db.update( { 'file': event.fileName, 'dir': event.directory },
 									{ 'file': event.info[0], 'dir': event.info[1] } )
+					if self.chunks != None:
+						self.chunks.rename( event.path, os.path.join( event.watchdir, event.info[1], event.info[0] ) )
 			else:
 				pass
 				#raise NotImplementedError( 'processEvent called with "{0}"!'.format( event ) )
+			for listener in self.listeners:
+				listener( event )
+
+	def queueChunks( self, path ):											# Индекс кусков досчитывается в фоновом потоке
+		if self.chunks != None and ( fileutils.get_size( path ) or 0 ) >= self.CHUNK_MIN_FILE:
+			self.chunkQueue.put( ( 'chunk', path ) )
 
-	def prepareEvent( self, path, root, basicAction, info = None ):													# Создаем Event
-		isDir = os.path.isdir( path )
+	def sharedContent( self, path ):										# [ ( путь, доля общих байт ) ] - файлы, у которых с path есть общие куски
+		if self.chunks == None:
+			return []
+		return self.chunks.shared( path )
+
+	@metrics.timed( 'prepare_event' )
+	def prepareEvent( self, path, root, basicAction, info = None, isDir = None ):									# Создаем Event
+		f_stat, f_hash = self.hashed.pop( path, ( None, None ) )
+		if f_stat != None and f_stat != fileutils.get_stat( path ):		# Файл изменился после подсчёта пулом - хэш устарел
+			f_stat, f_hash = None, None
+		if isDir == None:
+			isDir = os.path.isdir( path )
 		f, d = fileutils.get_file_and_dir( path, root, isDir )
-		res_path = self.db.find( flags = { 're': False }, file = f, dir = d )
+		res_path = self.db.find( flags = { 're': False, 'limit': 2 }, file = f, dir = d )	# Больше двух записей не нужно: две - уже ошибка
 		basicEvent = Event( f, d, isDir, root, info )
 		if len( res_path ) or basicAction == Event.ACTION.RENAMED:
 			basicEvent.isInDB = True
@@ -169,9 +505,28 @@ class Engine( watchdog.events.FileSystemEventHandler ):
 		if not isDir and ( basicAction in (Event.ACTION.MISSING, Event.ACTION.NEW, Event.ACTION.RENAMED, Event.ACTION.UPDATED) ):
 			if len( res_path ) > 1:
 				raise RuntimeError( 'В базе данных сразу две записи об одном файле! Нужна полная проверка базы.' )
-			if os.path.exists( path ):
-				f_hash = fileutils.get_hash( path )
-				res_hash = self.db.find( hash = f_hash )
+			exists = os.path.exists( path )
+			if not exists and basicAction == Event.ACTION.RENAMED and info and os.path.exists( info ):
+				return self.prepareMoved( basicEvent, res_path, root, info )
+			if exists:
+				if len( res_path ):
+					algorithm = self.hashAlgorithm
+					if res_path[0]['hash'] != None:
+						algorithm = fileutils.hash_algorithm( res_path[0]['hash'] )	# Сравниваем тем же алгоритмом, каким хэш записан в базу
+					if f_hash != None and fileutils.hash_algorithm( f_hash ) != algorithm:
+						f_stat, f_hash = None, None
+					if f_hash == None:
+						f_hash = self.cachedHash( path, root, res_path[0] )
+						if f_hash != None:
+							f_stat = res_path[0]['stat']
+					if f_hash == None:
+						f_stat, f_hash = self.statAndHash( path, algorithm )
+					if res_path[0]['hash'] == None and f_hash != None:			# Запись добавили без хэша и он ещё не досчитан
+						self.db.update( { 'file': f, 'dir': d }, { 'hash': f_hash, 'stat': f_stat } if f_stat else { 'hash': f_hash } )
+					res_hash = []
+				else:
+					f_stat, f_hash, res_hash = self.findDuplicates( path, f_stat, f_hash )
+				basicEvent.stat = f_stat
 				if len( res_path ):
 					if res_path[0]['hash'] != f_hash:								# Файл есть на диске и в базе не совпал хэш.
 						if basicAction == Event.ACTION.UPDATED:
@@ -194,35 +549,124 @@ class Engine( watchdog.events.FileSystemEventHandler ):
 						basicEvent.fileName = new_f
 						basicEvent.directory = new_d
 					basicEvent.info = f_hash
+					if basicAction != Event.ACTION.RENAMED:
+						self.checkSimilar( basicEvent, path )
 			elif len( res_path ):													# Файла на диске нет, но в базе есть.
 				basicEvent.action = Event.ACTION.MISSING
 		else:
 			basicEvent.action = basicAction
+			if isDir and basicAction == Event.ACTION.RENAMED and info:
+				basicEvent.info = fileutils.get_file_and_dir( info, root, True )	# Как и у файлов: processEvent ждёт ( имя, папка )
 				 
-		#print( '[EVENT]:', basicEvent )
 		return basicEvent
 
 
-	def on_any_event( self, event ):
-		print( event )
-		info = None
+	def prepareMoved( self, basicEvent, res_path, root, dest ):			# Файл уже на новом месте: исходного пути на диске нет
+		if not len( res_path ):												# В базе его не было - просто новый файл
+			return self.prepareEvent( dest, root, Event.ACTION.NEW, isDir = False )
+		new_f, new_d = fileutils.get_file_and_dir( dest, root )
+		if len( self.db.find( flags = { 're': False, 'limit': 1 }, file = new_f, dir = new_d ) ):	# Переименовали поверх известного файла
+			basicEvent.action = Event.ACTION.MISSING
+			self.queue.put( ( 'event', ( dest, root, Event.ACTION.UPDATED ) ), force = True )
+			return basicEvent
+		record = res_path[0]
+		f_hash = self.cachedHash( dest, root, record )						# Переименование не меняет подпись файла
+		if f_hash == None and record['hash'] != None:
+			f_hash = fileutils.get_hash( dest, fileutils.hash_algorithm( record['hash'] ) )
+		basicEvent.action = Event.ACTION.RENAMED
+		basicEvent.info = ( new_f, new_d )
+		if f_hash != record['hash']:										# Пока переименовывали, содержимое поменялось
+			self.queue.put( ( 'event', ( dest, root, Event.ACTION.UPDATED ) ), force = True )
+		return basicEvent
+
+	def checkSimilar( self, event, path ):									# Похожая картинка уже есть: SIMILAR, а если новая лучше - FOUND_BETTER
+		ph, resolution = phash.image_hash( path )
+		if ph == None:
+			return
+		event.image = ( ph, resolution )
+		similar = self.shards.find_similar( ph, self.SIMILAR_DISTANCE )
+		if not similar:
+			return
+		event.similar = similar
+		quality = lambda res, size: ( res[0] * res[1] if res else 0, size or 0 )	# Сначала разрешение, потом размер файла
+		best = max( quality( i.get( 'resolution' ), i.get( 'size' ) ) for i in similar )
+		if quality( resolution, fileutils.get_size( path ) ) > best:
+			event.action = Event.ACTION.FOUND_BETTER
+		else:
+			event.action = Event.ACTION.SIMILAR
+
+	def on_any_event( self, event ):										# Сырые события только копятся, обработка - когда файл успокоится
+		metrics.METRICS.count( 'events_received' )
+		dest = None
 		if isinstance( event, watchdog.events.FileCreatedEvent ):
-			evType = Event.ACTION.NEW
+			kind = Coalescer.CREATED
 		elif isinstance( event, watchdog.events.FileDeletedEvent ):
-			evType = Event.ACTION.MISSING
+			kind = Coalescer.DELETED
 		elif isinstance( event, watchdog.events.FileMovedEvent ):
-			evType = Event.ACTION.RENAMED
-			info = event.dest_path								
+			kind = Coalescer.MOVED
+			dest = event.dest_path
 		elif isinstance( event, watchdog.events.FileModifiedEvent ):
-			evType = Event.ACTION.UPDATED
+			kind = Coalescer.MODIFIED
+		elif isinstance( event, watchdog.events.DirMovedEvent ):		# Папка переезжает целиком и сразу, копить нечего
+			self.queue.put( ( 'event', ( event.src_path, self.cfg[0], Event.ACTION.RENAMED, event.dest_path, True ) ) )
+			return
 		else:
 			return
 		if event.src_path in self.ignoreFiles:
 			self.ignoreFiles.remove( event.src_path )
 			return
-		else:
-			print( event.src_path, self.ignoreFiles )
-		self.processEvent( self.prepareEvent( event.src_path, self.cfg[0], evType, info ) )	
+		self.coalescer.push( kind, event.src_path, dest )
+
+	def onSettled( self, kind, path, info ):								# Хэширование и запись в базу - уже в обработчиках очереди
+		self.queue.put( ( 'event', ( path, self.cfg[0], self.SETTLED_ACTIONS[kind], info ) ) )
+
+
+class Monitor:																# По обработчику, наблюдателю и базе на каждый корень из cfg
+	DB_NAME = 'db.{0}.sqlite'
+	METRICS_INTERVAL = 60.0														# Как часто выгружать метрики в приёмники
+
+	def __init__( self, roots, outFunc = None, sinks = () ):				# sinks - например metrics.LogSink() или metrics.PrometheusFileSink( путь )
+		metrics.METRICS.sinks += sinks
+		self.shards = ShardedDataBase()
+		self.bucket = TokenBucket( Engine.BACKGROUND_RATE, Engine.BACKGROUND_BURST )	# Корни обычно на одних дисках - бюджет общий
+		self.engines = []
+		for root in roots:
+			engine = Engine( outFunc, self.shards, self.bucket )
+			engine.cfg = [ root ]
+			self.engines.append( engine )
+
+	def dbName( self, n, root ):											# Первый корень остаётся в старом файле базы
+		if n == 0:
+			return Engine.DEFAULT_DB_NAME
+		return self.DB_NAME.format( hashlib.sha1( root.encode() ).hexdigest()[:12] )
+
+	def find( self, flags = {}, **pattern ):
+		return self.shards.find( flags, **pattern )
+
+	def legacyShard( self, dbFile = 'db' ):									# Старую базу-pickle импортирует один корень: тот, для которого она велась
+		db = load_pickle( dbFile )
+		if db == None:
+			return None
+		roots = [ e.cfg[0] for e in self.engines ]
+		return roots.index( db.get( 'dir' ) ) if db.get( 'dir' ) in roots else 0
+
+	def run( self ):
+		legacy = self.legacyShard()
+		for n, engine in enumerate( self.engines ):
+			engine.start( self.dbName( n, engine.cfg[0] ), legacy = n == legacy )
+		metrics.METRICS.start( self.METRICS_INTERVAL )
+		try:
+			while True:
+				inp = input()
+				if inp == 'm':
+					print( metrics.METRICS.snapshot() )
+				for engine in self.engines:
+					engine.command( inp )
+				time.sleep( 0.5 )
+		except KeyboardInterrupt:
+			for engine in self.engines:
+				engine.stop()
+			metrics.METRICS.stop()
 
 
 if __name__ == '__main__':
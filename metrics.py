@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import logging
+import functools
+import threading
+
+class Metrics:																# Счётчики, текущие значения и таймеры, общие для всех потоков
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		self.timers = {}													# имя -> [ количество, сумма секунд, максимум секунд ]
+		self.sinks = []
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def count( self, name, value = 1 ):
+		with self.lock:
+			self.counters[name] = self.counters.get( name, 0 ) + value
+
+	def gauge( self, name, value ):
+		self.gauges[name] = value											# Одно присваивание, блокировка не нужна
+
+	def observe( self, name, seconds ):
+		with self.lock:
+			timer = self.timers.get( name )
+			if timer == None:
+				self.timers[name] = [ 1, seconds, seconds ]
+			else:
+				timer[0] += 1
+				timer[1] += seconds
+				timer[2] = max( timer[2], seconds )
+
+	def snapshot( self ):													# Плоский словарь имя -> значение
+		with self.lock:
+			res = dict( self.counters )
+			res.update( self.gauges )
+			for name, ( n, total, longest ) in self.timers.items():
+				res[name + '_count'] = n
+				res[name + '_seconds_total'] = total
+				res[name + '_seconds_max'] = longest
+			return res
+
+	def reset( self ):
+		with self.lock:
+			self.counters, self.gauges, self.timers = {}, {}, {}
+
+	def emit( self ):
+		snapshot = self.snapshot()
+		for sink in self.sinks:
+			sink( snapshot )
+
+	def start( self, interval ):											# Периодическая выгрузка во все приёмники
+		self.stopped.clear()
+		self.thread = threading.Thread( target = self._loop, args = ( interval, ), daemon = True )
+		self.thread.start()
+
+	def stop( self ):
+		self.stopped.set()
+		if self.thread != None:
+			self.thread.join()
+			self.thread = None
+		self.emit()
+
+	def _loop( self, interval ):
+		while not self.stopped.wait( interval ):
+			self.emit()
+
+
+class LogSink:
+	def __init__( self, logger = None ):
+		self.logger = logger or logging.getLogger( 'pyMediaMonitor.metrics' )
+
+	def __call__( self, snapshot ):
+		self.logger.info( ' '.join( '{0}={1}'.format( k, v ) for k, v in sorted( snapshot.items() ) ) )
+
+
+class PrometheusFileSink:													# Текстовый формат Prometheus для node_exporter textfile
+	def __init__( self, fileName, prefix = 'pymediamonitor_' ):
+		self.fileName = fileName
+		self.prefix = prefix
+
+	def __call__( self, snapshot ):
+		lines = [ '{0}{1} {2}'.format( self.prefix, k, v ) for k, v in sorted( snapshot.items() ) if v != None ]
+		with open( self.fileName + '.tmp', 'w' ) as f:
+			f.write( '\n'.join( lines ) + '\n' )
+		os.replace( self.fileName + '.tmp', self.fileName )				# Читатель не увидит файл наполовину
+
+
+METRICS = Metrics()															# Общий экземпляр: модулям не нужно передавать его друг другу
+
+def timed( name ):															# Декоратор: время каждого вызова в таймер name
+	def decorator( func ):
+		@functools.wraps( func )
+		def wrapper( *args, **kwargs ):
+			start = time.perf_counter()
+			try:
+				return func( *args, **kwargs )
+			finally:
+				METRICS.observe( name, time.perf_counter() - start )
+		return wrapper
+	return decorator
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+
+try:
+	from PIL import Image													# Необязательная зависимость: без неё картинки не сравниваются
+except ImportError:
+	Image = None
+
+try:
+	import numpy															# Необязательная зависимость: пакетный подсчёт хэшей
+except ImportError:
+	numpy = None
+
+IMAGE_EXTENSIONS = { '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tif', '.tiff' }
+GRID_WIDTH, GRID_HEIGHT = 9, 8												# dHash: 8 сравнений соседей в 8 строках - 64 бита
+
+def hamming( a, b ):
+	return ( a ^ b ).bit_count()
+
+def load_grid( path ):														# Яркости картинки, сжатой до 9x8, и её исходное разрешение
+	if Image == None or os.path.splitext( path )[1].lower() not in IMAGE_EXTENSIONS:
+		return None, None
+	try:
+		with Image.open( path ) as img:
+			resolution = img.size
+			img.draft( 'L', ( GRID_WIDTH * 4, GRID_HEIGHT * 4 ) )			# JPEG сразу декодируется в уменьшенном виде
+			data = list( img.convert( 'L' ).resize( ( GRID_WIDTH, GRID_HEIGHT ) ).getdata() )
+	except ( OSError, ValueError ):
+		return None, None
+	return [ data[r * GRID_WIDTH:( r + 1 ) * GRID_WIDTH] for r in range( GRID_HEIGHT ) ], resolution
+
+def dhash( grid ):
+	value = 0
+	for row in grid:
+		for x in range( GRID_WIDTH - 1 ):
+			value = value << 1 | ( row[x] > row[x + 1] )
+	return value
+
+def dhash_batch( grids ):													# Сразу для многих картинок, с NumPy - одной операцией
+	if numpy == None or not grids:
+		return [ dhash( g ) for g in grids ]
+	a = numpy.asarray( grids, dtype = numpy.int16 )
+	bits = numpy.packbits( ( a[:, :, :-1] > a[:, :, 1:] ).reshape( len( grids ), -1 ), axis = 1 )
+	return [ int.from_bytes( row.tobytes(), 'big' ) for row in bits ]
+
+def image_hash( path ):														# ( хэш, разрешение ) или ( None, None ), если это не картинка
+	return hash_many( [ path ] )[0]
+
+def hash_many( paths ):
+	loaded = [ load_grid( p ) for p in paths ]
+	hashes = iter( dhash_batch( [ grid for grid, resolution in loaded if grid != None ] ) )
+	return [ ( next( hashes ), resolution ) if grid != None else ( None, None ) for grid, resolution in loaded ]
+
+
+class BKTree:																# Поиск по расстоянию Хэмминга без полного перебора
+	def __init__( self ):
+		self.root = None													# узел: [ ключ, { значения }, { расстояние: узел } ]
+
+	def add( self, key, value ):
+		if self.root == None:
+			self.root = [ key, { value }, {} ]
+			return
+		node = self.root
+		while True:
+			d = hamming( key, node[0] )
+			if d == 0:
+				node[1].add( value )
+				return
+			child = node[2].get( d )
+			if child == None:
+				node[2][d] = [ key, { value }, {} ]
+				return
+			node = child
+
+	def remove( self, key, value ):											# Узел остаётся для маршрутизации, убирается только значение
+		node = self.root
+		while node != None:
+			d = hamming( key, node[0] )
+			if d == 0:
+				node[1].discard( value )
+				return
+			node = node[2].get( d )
+
+	def search( self, key, radius ):										# [ ( расстояние, значение ) ] по возрастанию расстояния
+		res = []
+		stack = [ self.root ] if self.root != None else []
+		while stack:
+			node = stack.pop()
+			d = hamming( key, node[0] )
+			if d <= radius:
+				res += [ ( d, v ) for v in node[1] ]
+			stack += [ child for k, child in node[2].items() if d - radius <= k <= d + radius ]
+		return sorted( res )
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import sys
+import collections.abc
+
+_MISSING = object()
+_TAGSETS = {}																# Одинаковые наборы тэгов - один объект на всю базу
+
+def intern_tags( tags ):
+	tags = frozenset( tags )
+	return _TAGSETS.setdefault( tags, tags )
+
+def encode_hash( fileHash ):												# hex -> 32 байта, 'алгоритм:hex' -> ( алгоритм, байты ), остальное как есть
+	if type( fileHash ) is not str:
+		return fileHash
+	algorithm, sep, digest = fileHash.rpartition( ':' )
+	try:
+		raw = bytes.fromhex( digest )
+	except ValueError:
+		return fileHash
+	if not raw or raw.hex() != digest:										# Только то, что восстановится в ту же строку
+		return fileHash
+	return ( sys.intern( algorithm ), raw ) if sep else raw
+
+def decode_hash( value ):
+	if type( value ) is bytes:
+		return value.hex()
+	if type( value ) is tuple:
+		return value[0] + ':' + value[1].hex()
+	return value
+
+class Directory:															# Папка - одна на все свои записи, переименование меняет только её
+	__slots__ = ( 'name', 'count' )
+
+	def __init__( self, name ):
+		self.name = name
+		self.count = 0
+
+	def __repr__( self ):
+		return 'Directory({0!r})'.format( self.name )
+
+class Record( collections.abc.MutableMapping ):								# Запись о файле: поля в слотах, но ведёт себя как dict
+	__slots__ = ( 'file', 'dir', 'size', 'created', 'hash', 'tags', 'url', 'google', 'stat', 'sample', 'phash', 'resolution', 'extra' )
+	FIELDS = __slots__[:-1]
+
+	def __init__( self, data = () ):
+		for k in self.__slots__:
+			setattr( self, k, _MISSING )
+		self.update( data )
+
+	@staticmethod
+	def encode( key, value ):												# Так значение хранится в записи и в индексах базы
+		if key == 'hash':
+			return encode_hash( value )
+		if key == 'dir' and type( value ) is str:
+			return sys.intern( value )
+		if key == 'tags' and isinstance( value, ( set, frozenset ) ):
+			return intern_tags( value )
+		return value
+
+	def raw( self, key ):													# Хранимое значение без декодирования, None если поля нет
+		if key in self.FIELDS:
+			value = getattr( self, key )
+			return None if value is _MISSING else value
+		if self.extra is _MISSING:
+			return None
+		return self.extra.get( key )
+
+	def __getitem__( self, key ):
+		if key in self.FIELDS:
+			value = getattr( self, key )
+			if value is _MISSING:
+				raise KeyError( key )
+			if key == 'hash':
+				return decode_hash( value )
+			if type( value ) is Directory:
+				return value.name
+			return value
+		if self.extra is _MISSING:
+			raise KeyError( key )
+		return self.extra[key]
+
+	def __setitem__( self, key, value ):
+		if key in self.FIELDS:
+			setattr( self, key, self.encode( key, value ) )
+		else:
+			if self.extra is _MISSING:
+				self.extra = {}
+			self.extra[key] = value
+
+	def __delitem__( self, key ):
+		if key in self.FIELDS and getattr( self, key ) is not _MISSING:
+			setattr( self, key, _MISSING )
+		elif key not in self.FIELDS and self.extra is not _MISSING and key in self.extra:
+			del self.extra[key]
+		else:
+			raise KeyError( key )
+
+	def __iter__( self ):
+		for k in self.FIELDS:
+			if getattr( self, k ) is not _MISSING:
+				yield k
+		if self.extra is not _MISSING:
+			yield from self.extra
+
+	def __len__( self ):
+		return sum( 1 for k in self )
+
+	def __eq__( self, other ):
+		if isinstance( other, collections.abc.Mapping ):
+			return dict( self.items() ) == dict( other.items() )
+		return NotImplemented
+
+	__hash__ = None
+
+	def __repr__( self ):
+		return repr( dict( self.items() ) )
+
+	def __reduce__( self ):													# В pickle и deepcopy - обычный словарь полей
+		return ( Record, ( dict( self.items() ), ) )
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import threading
+import traceback
+import metrics
+
+from storage import dump_pickle
+
+class Snapshotter:															# Фоновые снимки базы в pickle: по времени или по числу изменений
+	DEFAULT_INTERVAL = 300.0
+	DEFAULT_DIRTY = 10000
+	CHECK_EVERY = 1.0
+
+	def __init__( self, db, fileName, interval = None, dirtyThreshold = None, clock = time.monotonic ):
+		self.db = db
+		self.fileName = fileName
+		self.interval = interval if interval != None else self.DEFAULT_INTERVAL
+		self.dirtyThreshold = dirtyThreshold if dirtyThreshold != None else self.DEFAULT_DIRTY
+		self.clock = clock
+		self.last = clock()
+		self.stopped = threading.Event()
+		self.requested = threading.Event()
+		self.thread = None
+
+	def due( self, now = None ):
+		if now == None:
+			now = self.clock()
+		dirty = self.db.dirty
+		return dirty >= self.dirtyThreshold or dirty > 0 and now - self.last >= self.interval
+
+	def snapshot( self ):													# Обработчик событий в это время продолжает менять базу
+		start = time.perf_counter()
+		data = self.db.snapshot()
+		self.last = self.clock()
+		dump_pickle( data, self.fileName )
+		metrics.METRICS.observe( 'snapshot', time.perf_counter() - start )
+		return len( data['media'] )
+
+	def trigger( self ):													# Снимок вне очереди - его сделает фоновый поток, второй одновременно не начнётся
+		self.requested.set()
+
+	def start( self ):
+		self.stopped.clear()
+		self.thread = threading.Thread( target = self._loop, daemon = True )
+		self.thread.start()
+
+	def stop( self ):														# Последний снимок - если с прошлого что-то изменилось
+		self.stopped.set()
+		if self.thread != None:
+			self.thread.join()
+			self.thread = None
+		if self.db.dirty or self.requested.is_set():
+			self.requested.clear()
+			self.snapshot()
+
+	def _loop( self ):
+		while not self.stopped.wait( self.CHECK_EVERY ):
+			if self.requested.is_set() or self.due():
+				self.requested.clear()
+				try:
+					self.snapshot()
+				except Exception:											# Неудачный снимок не должен останавливать следующие
+					print( 'Ошибка при сохранении снимка {0}:'.format( self.fileName ), file = sys.stderr )
+					traceback.print_exc()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import metrics
+
+from contextlib import contextmanager
+from record import Record
+
+def load_pickle( dbFile ):
+	try:
+		with open( dbFile, 'rb' ) as f:
+			return pickle.load( f )
+	except FileNotFoundError:
+		return None
+
+def dump_pickle( db, dbFile ):											# Через временный файл: при сбое остаётся старая копия целиком
+	with open( dbFile + '.tmp', 'wb' ) as f:
+		pickle.dump( db, f, pickle.HIGHEST_PROTOCOL )
+		f.flush()
+		os.fsync( f.fileno() )
+	os.replace( dbFile + '.tmp', dbFile )
+
+class Storage:																# Хранилище по умолчанию - ничего не сохраняет, база живёт только в памяти
+	def load( self ):
+		return None
+
+	def import_db( self, db ):
+		pass
+
+	def add( self, elem ):
+		pass
+
+	def update( self, elem ):
+		pass
+
+	def remove( self, elems ):
+		pass
+
+	def rename_dir( self, old, new ):
+		pass
+
+	@contextmanager
+	def transaction( self ):
+		yield
+
+	def close( self ):
+		pass
+
+
+class SqliteStorage( Storage ):
+	COLUMNS = ( 'dir', 'file', 'size', 'created', 'hash' )					# Остальные поля записи хранятся в pickle-блобе 'rest'
+
+	def __init__( self, dbFile ):
+		self.dbFile = dbFile
+		self.conn = sqlite3.connect( dbFile, check_same_thread = False )
+		self.lock = threading.RLock()
+		self.rowids = {}													# id( элемента ) -> rowid
+		self.depth = 0
+		with self.lock:
+			self.conn.executescript( '''
+				CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value BLOB );
+				CREATE TABLE IF NOT EXISTS media ( id INTEGER PRIMARY KEY, dir TEXT, file TEXT, size INTEGER,
+												   created INTEGER, hash TEXT, rest BLOB );
+				CREATE INDEX IF NOT EXISTS media_hash ON media ( hash );
+				CREATE INDEX IF NOT EXISTS media_path ON media ( dir, file );
+			''' )
+			self.conn.commit()
+
+	def _row( self, elem ):
+		rest = { k: v for k, v in elem.items() if k not in self.COLUMNS }
+		return tuple( elem.get( k ) for k in self.COLUMNS ) + ( pickle.dumps( rest ), )
+
+	def _commit( self ):
+		if not self.depth:
+			start = time.perf_counter()
+			self.conn.commit()
+			metrics.METRICS.observe( 'storage_commit', time.perf_counter() - start )
+
+	@contextmanager
+	def transaction( self ):												# Вложенные операции коммитятся один раз в конце
+		with self.lock:
+			self.depth += 1
+			try:
+				yield
+			finally:
+				self.depth -= 1
+				self._commit()
+
+	def load( self ):
+		with self.lock:
+			row = self.conn.execute( "SELECT value FROM meta WHERE key = 'dir'" ).fetchone()
+			if row == None:
+				return None
+			db = { 'dir': pickle.loads( row[0] ), 'tags': {}, 'media': [] }
+			self.rowids = {}
+			for row in self.conn.execute( 'SELECT id, {0}, rest FROM media ORDER BY id'.format( ', '.join( self.COLUMNS ) ) ):
+				elem = Record( zip( self.COLUMNS, row[1:-1] ) )					# Сразу Record: база не подменит объект, и rowids останутся верными
+				elem.update( pickle.loads( row[-1] ) )
+				for t in elem.get( 'tags' ) or ():
+					db['tags'][t] = db['tags'].get( t, 0 ) + 1
+				self.rowids[id( elem )] = row[0]
+				db['media'].append( elem )
+			return db
+
+	def import_db( self, db ):
+		with self.transaction():
+			self.conn.execute( 'DELETE FROM media' )
+			self.conn.execute( "INSERT OR REPLACE INTO meta VALUES ( 'dir', ? )", ( pickle.dumps( db['dir'] ), ) )
+			self.rowids = {}
+			for elem in db['media']:
+				self.add( elem )
+
+	def add( self, elem ):
+		with self.lock:
+			cur = self.conn.execute( 'INSERT INTO media ( {0}, rest ) VALUES ( {1} )'.format(
+				', '.join( self.COLUMNS ), ', '.join( '?' * ( len( self.COLUMNS ) + 1 ) ) ), self._row( elem ) )
+			self.rowids[id( elem )] = cur.lastrowid
+			self._commit()
+
+	def update( self, elem ):
+		with self.lock:
+			self.conn.execute( 'UPDATE media SET {0}, rest = ? WHERE id = ?'.format( ', '.join( k + ' = ?' for k in self.COLUMNS ) ),
+							   self._row( elem ) + ( self.rowids[id( elem )], ) )
+			self._commit()
+
+	def remove( self, elems ):
+		with self.lock:
+			self.conn.executemany( 'DELETE FROM media WHERE id = ?', [ ( self.rowids.pop( id( e ) ), ) for e in elems ] )
+			self._commit()
+
+	def rename_dir( self, old, new ):										# Один запрос по индексу ( dir, file ), без чтения строк в Python
+		with self.lock:
+			self.conn.execute( 'UPDATE media SET dir = ? WHERE dir = ?', ( new, old ) )
+			self._commit()
+
+	def close( self ):
+		with self.lock:
+			self.conn.commit()
+			self.conn.close()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import re
+
+# Запросы вида:  cats & ( dogs | !'old tag' ) & size>1000 & file~'\.png$'
+# & и and, | и or, ! и not; поле=значение, поле~регулярка, поле<число, поле>число; остальные слова - тэги
+TOKEN = re.compile( r'''\s*(?:(?P<op>[()&|!])|(?P<cmp>[=~<>])|"(?P<dq>(?:[^"\\]|\\.)*)"|'(?P<sq>(?:[^'\\]|\\.)*)'|(?P<word>[^\s()&|!=~<>"']+))''' )
+KEYWORDS = { 'and': '&', 'or': '|', 'not': '!' }
+
+def tokenize( text ):
+	tokens = []
+	pos = 0
+	text = text.rstrip()
+	while pos < len( text ):
+		m = TOKEN.match( text, pos )
+		if m == None:
+			raise ValueError( 'Не удалось разобрать запрос с позиции {0}: {1}'.format( pos, text[pos:] ) )
+		pos = m.end()
+		if m.group( 'op' ) or m.group( 'cmp' ):
+			tokens.append( ( 'op', m.group( 'op' ) or m.group( 'cmp' ) ) )
+		elif m.group( 'word' ) != None:
+			word = m.group( 'word' )
+			if word.lower() in KEYWORDS:
+				tokens.append( ( 'op', KEYWORDS[word.lower()] ) )
+			else:
+				tokens.append( ( 'word', word ) )
+		else:
+			quoted = m.group( 'dq' ) if m.group( 'dq' ) != None else m.group( 'sq' )
+			tokens.append( ( 'str', re.sub( r'\\([\'"])', r'\1', quoted ) ) )		# Остальные \ оставляем для регулярок
+	return tokens
+
+def parse( text ):															# Строка -> дерево: ( 'tag', t ), ( 'field', k, op, v ), ( 'not', x ), ( 'and' | 'or', [ ... ] )
+	tokens = tokenize( text )
+	node, pos = _parse_or( tokens, 0 )
+	if pos != len( tokens ):
+		raise ValueError( 'Лишнее в конце запроса: {0}'.format( tokens[pos:] ) )
+	return node
+
+def _peek( tokens, pos ):
+	return tokens[pos] if pos < len( tokens ) else ( None, None )
+
+def _parse_or( tokens, pos ):
+	items = []
+	while True:
+		node, pos = _parse_and( tokens, pos )
+		items.append( node )
+		if _peek( tokens, pos ) != ( 'op', '|' ):
+			break
+		pos += 1
+	return ( items[0] if len( items ) == 1 else ( 'or', items ) ), pos
+
+def _parse_and( tokens, pos ):
+	items = []
+	while True:
+		node, pos = _parse_not( tokens, pos )
+		items.append( node )
+		if _peek( tokens, pos ) != ( 'op', '&' ):
+			break
+		pos += 1
+	return ( items[0] if len( items ) == 1 else ( 'and', items ) ), pos
+
+def _parse_not( tokens, pos ):
+	kind, value = _peek( tokens, pos )
+	if ( kind, value ) == ( 'op', '!' ):
+		node, pos = _parse_not( tokens, pos + 1 )
+		return ( 'not', node ), pos
+	if ( kind, value ) == ( 'op', '(' ):
+		node, pos = _parse_or( tokens, pos + 1 )
+		if _peek( tokens, pos ) != ( 'op', ')' ):
+			raise ValueError( 'Не закрыта скобка в запросе!' )
+		return node, pos + 1
+	if kind not in ( 'word', 'str' ):
+		raise ValueError( 'Ожидался тэг или поле, а получено: {0}'.format( value ) )
+	nextKind, op = _peek( tokens, pos + 1 )
+	if kind == 'word' and nextKind == 'op' and op in '=~<>':
+		valueKind, v = _peek( tokens, pos + 2 )
+		if valueKind not in ( 'word', 'str' ):
+			raise ValueError( 'Нет значения для поля {0}!'.format( value ) )
+		if valueKind == 'word':
+			v = _literal( v )
+		return ( 'field', value, op, v ), pos + 3
+	return ( 'tag', value ), pos + 1
+
+def _literal( word ):														# Числа без кавычек - числа, None - None
+	if word == 'None':
+		return None
+	try:
+		return int( word )
+	except ValueError:
+		return word
@@ -5,11 +5,33 @@ import pickle
 import os
 import time
 import shutil
+import tempfile
+import hashlib
+import re
+import random
 
 from copy import deepcopy
-from main import Engine, Event
-from database import DataBase
-from fileutils import get_size, get_created, get_hash, get_file_and_dir
+from main import Engine, Event, Monitor
+from asyncengine import AsyncEngine
+from database import DataBase, ShardedDataBase
+from record import Record
+import tagquery
+import phash
+import metrics
+import bench
+import json
+import fileutils
+from storage import SqliteStorage, load_pickle, dump_pickle
+from snapshot import Snapshotter
+from chunkindex import ChunkIndex
+from throttle import TokenBucket, low_priority
+from hashpool import HashPool
+from coalescer import Coalescer
+from workqueue import WorkQueue
+import threading
+import asyncio
+import watchdog.events
+from fileutils import get_size, get_created, get_hash, get_file_and_dir, get_stat, hash_algorithm
 
 
 class EmptyEngineClass( unittest.TestCase ):
@@ -26,55 +48,201 @@ class EmptyEngineClass( unittest.TestCase ):
 	def tearDown( self ):
 		del self.engine
 
+	def drain( self ):
+		self.engine.queue.put( 'quit' )
+		Engine.worker( self.engine )										# Сам цикл обработчика, без потока
 
-########################################################################
-# TODO: Реализовать обработку множества путей в cfg					   #
-# TODO: Rewrite flags in database to deal with each value. (+or/and)   #
-########################################################################
 
 
-class TestUpdateAll( EmptyEngineClass ):
-	def test_new_file( self ):
-		files = [os.path.join( self.DEFAULT_CFG[0], 'file_1' )]
+class TreeEngineClass( EmptyEngineClass ):
+	def setUp( self ):
+		EmptyEngineClass.setUp( self )
+		self.root = tempfile.mkdtemp( dir = 'TEST_DIR' )
+		self.engine.cfg = [ self.root ]
+		self.engine.db.db['dir'] = self.root
+
+	def tearDown( self ):
+		shutil.rmtree( self.root )
+		EmptyEngineClass.tearDown( self )
+
+	def make( self, *names ):
+		for name in names:
+			path = os.path.join( self.root, name )
+			if name.endswith( '/' ):
+				os.makedirs( path, exist_ok = True )
+			else:
+				os.makedirs( os.path.dirname( path ), exist_ok = True )
+				with open( path, 'wb' ) as f:
+					f.write( name.encode() )
+		return [ os.path.join( self.root, os.path.normpath( n ) ) for n in names ]
+
+
+class TestUpdateAll( TreeEngineClass ):
+	def scan( self, **kwargs ):
 		ev = Event( None, None, None, None )
-		with unittest.mock.patch( 'glob.iglob', return_value = files ) as glob_mock:
-			with unittest.mock.patch( 'os.path.isdir', return_value = False ):
-				with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = ev ) as p:
-					self.engine.updateAllInPath( self.DEFAULT_CFG[0], self.DEFAULT_CFG[0] )
-					p.assert_called_once_with( files[0], self.DEFAULT_CFG[0], Event.ACTION.NEW )
+		with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = ev ) as p:
+			self.engine.updateAllInPath( self.root, self.root, **kwargs )
+			self.drain()
+			return sorted( c[0] for c in p.call_args_list )
+
+	def test_new_file( self ):
+		files = self.make( 'file_1' )
+		self.assertEqual( self.scan(), [ ( files[0], self.root, Event.ACTION.NEW, None, False ) ] )
 
 	def test_new_dir_empty( self ):
-		side_effect = lambda x: files if x == os.path.join(self.DEFAULT_CFG[0], '*') else []
-		files = [os.path.join( self.DEFAULT_CFG[0], 'dir_1' )]
-		ev = Event( None, None, None, None )
-		with unittest.mock.patch( 'glob.iglob', side_effect = side_effect ):
-			with unittest.mock.patch( 'os.path.isdir', return_value = True ):
-				with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = ev ) as p:
-					self.engine.updateAllInPath( self.DEFAULT_CFG[0], self.DEFAULT_CFG[0] )
-					self.assertEqual( p.call_count, 0 )
+		self.make( 'dir_1/' )
+		self.assertEqual( self.scan(), [] )
 
 	def test_new_dir_with_one_file( self ):
-		side_effect_iglob = lambda x: dirs if x == os.path.join(self.DEFAULT_CFG[0], '*') else files
-		side_effect_isdir = lambda x: True if x == os.path.join(dirs[0]) else False
-		dirs = [os.path.join( self.DEFAULT_CFG[0], 'dir_1' )]
-		files = [os.path.join( dirs[0], 'file_1' )]
-		ev = Event( None, None, None, None )
-		with unittest.mock.patch( 'glob.iglob', side_effect = side_effect_iglob ):
-			with unittest.mock.patch( 'os.path.isdir', side_effect = side_effect_isdir ):
-				with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = ev ) as p:
-					self.engine.updateAllInPath( self.DEFAULT_CFG[0], self.DEFAULT_CFG[0] )
-					p.assert_called_once_with( files[0], self.DEFAULT_CFG[0], Event.ACTION.NEW )
+		files = self.make( 'dir_1/file_1' )
+		self.assertEqual( self.scan(), [ ( files[0], self.root, Event.ACTION.NEW, None, False ) ] )
 
 	def test_new_dir_with_dir( self ):
-		side_effect = lambda x: dirs if x == os.path.join(self.DEFAULT_CFG[0], '*') else dirs_inside
-		dirs = [os.path.join( self.DEFAULT_CFG[0], 'dir_1' )]
-		dirs_inside = [os.path.join( dirs[0], 'dir_inside' )]
-		ev = Event( None, None, None, None )
-		with unittest.mock.patch( 'glob.iglob', side_effect = side_effect ):
-			with unittest.mock.patch( 'os.path.isdir', return_value = True ):
-				with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = ev ) as p:
-					self.engine.updateAllInPath( self.DEFAULT_CFG[0], self.DEFAULT_CFG[0] )
-					p.assert_called_once_with( dirs_inside[0], self.DEFAULT_CFG[0], Event.ACTION.BROKEN_STRUCTURE )
+		dirs = self.make( 'dir_1/dir_inside/', 'dir_1/dir_inside/file' )
+		self.assertEqual( self.scan(), [ ( dirs[0], self.root, Event.ACTION.BROKEN_STRUCTURE, None, True ) ] )
+
+	def test_depth( self ):
+		files = self.make( 'dir_1/dir_inside/file' )
+		self.engine.SCAN_DEPTH = 3
+		self.assertEqual( self.scan(), [ ( files[0], self.root, Event.ACTION.NEW, None, False ) ] )
+
+	def test_skip_unchanged_dirs( self ):
+		self.engine.SKIP_UNCHANGED_DIRS = True
+		files = self.make( 'dir_1/file_1', 'file_2' )
+		self.assertEqual( len( self.scan() ), 2 )
+		self.assertEqual( [ c[0] for c in self.scan() ], [ files[1] ] )
+		self.assertEqual( len( self.scan( verify = True ) ), 2 )
+		self.make( 'dir_1/file_3' )
+		self.assertEqual( len( self.scan() ), 3 )
+
+	def test_symlinks( self ):												# Ссылка на папку - папка, битая ссылка пропускается
+		files = self.make( 'dir_1/file_1' )
+		os.symlink( os.path.abspath( os.path.join( self.root, 'dir_1' ) ), os.path.join( self.root, 'linked' ) )
+		os.symlink( os.path.abspath( os.path.join( self.root, 'nowhere' ) ), os.path.join( self.root, 'dir_1', 'dangling' ) )
+		self.assertEqual( self.scan(), sorted( [ ( files[0], self.root, Event.ACTION.NEW, None, False ),
+												 ( os.path.join( self.root, 'linked', 'file_1' ), self.root, Event.ACTION.NEW, None, False ) ] ) )
+
+	def test_hash_errors( self ):
+		self.make( 'dir_1/' )
+		self.assertEqual( get_hash( os.path.join( self.root, 'dir_1' ) ), None )
+
+	def test_hashes_from_pool( self ):
+		files = self.make( *[ 'dir/file_{0}'.format( i ) for i in range( 20 ) ] )
+		with unittest.mock.patch( 'fileutils.get_hash', side_effect = lambda x, algorithm: 'hash ' + x ):
+			self.engine.updateAllInPath( self.root, self.root )
+			self.drain()
+		self.assertEqual( sorted( i['hash'] for i in self.engine.db.db['media'] ), sorted( 'hash ' + f for f in files ) )
+		self.assertEqual( self.engine.hashed, {} )
+
+
+class TestReconcile( TreeEngineClass ):
+	def setUp( self ):
+		TreeEngineClass.setUp( self )
+		self.checkpoint = os.path.join( self.root, '..', os.path.basename( self.root ) + '.ckpt' )
+		self.make( 'a/x', 'b/old', 'b/copy_src' )
+		for d, f in ( ( 'a', 'x' ), ( 'b', 'old' ), ( 'b', 'copy_src' ) ):
+			self.engine.db.add( file = f, dir = d )
+		self.engine.db.add( file = 'gone', dir = 'a', hash = 'xxx' )
+		os.rename( os.path.join( self.root, 'b', 'old' ), os.path.join( self.root, 'b', 'new' ) )
+		shutil.copy( os.path.join( self.root, 'b', 'copy_src' ), os.path.join( self.root, 'c_copy' ) )
+		os.unlink( os.path.join( self.root, 'b', 'copy_src' ) )
+		self.make( 'c/fresh' )
+
+	def files( self ):
+		return sorted( ( i['dir'], i['file'] ) for i in self.engine.db.db['media'] )
+
+	def test_reconcile( self ):
+		self.assertEqual( self.engine.reconcile( self.root, self.checkpoint ), 4 )
+		self.drain()
+		self.assertEqual( self.files(), [ ( '', 'c_copy' ), ( 'a', 'x' ), ( 'b', 'new' ), ( 'c', 'fresh' ) ] )
+		self.assertFalse( os.path.exists( self.checkpoint ) )
+
+	def test_resume( self ):
+		self.engine.saveCheckpoint( self.checkpoint, { 'root': self.root, 'done': 'a', 'new': [], 'missing': [] } )
+		self.engine.reconcile( self.root, self.checkpoint )
+		self.drain()
+		self.assertIn( ( 'a', 'gone' ), self.files() )
+		self.assertIn( ( 'c', 'fresh' ), self.files() )
+
+	def test_broken_symlink( self ):										# Одна битая ссылка не должна стирать записи всей папки
+		os.symlink( os.path.join( self.root, 'nowhere' ), os.path.join( self.root, 'a', 'dangling' ) )
+		self.engine.reconcile( self.root, self.checkpoint )
+		self.drain()
+		self.assertIn( ( 'a', 'x' ), self.files() )
+		self.assertNotIn( ( 'a', 'dangling' ), self.files() )
+
+	def test_unreadable_dir( self ):
+		with unittest.mock.patch.object( self.engine, 'listDir', side_effect = lambda root, d: ( None, [] ) if d == 'a' else Engine.listDir( self.engine, root, d ) ):
+			self.engine.reconcile( self.root, self.checkpoint )
+		self.drain()
+		self.assertIn( ( 'a', 'x' ), self.files() )
+		self.assertIn( ( 'a', 'gone' ), self.files() )
+
+	def test_root_unavailable( self ):
+		self.assertEqual( self.engine.reconcile( os.path.join( self.root, 'unmounted' ), self.checkpoint ), 0 )
+		self.assertEqual( len( self.files() ), 4 )
+
+
+class TestMovedOnDisk( TreeEngineClass ):								# Событие о переименовании приходит, когда исходного файла уже нет
+	def setUp( self ):
+		TreeEngineClass.setUp( self )
+		self.src, self.dest = self.make( 'a/old', 'b/' )
+		self.dest = os.path.join( self.dest, 'new' )
+		self.engine.processEvent( self.engine.prepareEvent( self.src, self.root, Event.ACTION.NEW ) )
+		self.drain()														# Полный хэш досчитывается отдельным заданием
+
+	def files( self ):
+		return sorted( ( i['dir'], i['file'] ) for i in self.engine.db.db['media'] )
+
+	def move( self ):
+		os.rename( self.src, self.dest )
+		self.engine.processEvent( self.engine.prepareEvent( self.src, self.root, Event.ACTION.RENAMED, self.dest ) )
+		self.drain()
+
+	def test_renamed( self ):
+		with unittest.mock.patch( 'fileutils.get_hash', wraps = get_hash ) as hash_test:
+			self.move()
+			hash_test.assert_not_called()									# Подпись не изменилась - хэш из базы
+		self.assertEqual( self.files(), [ ( 'b', 'new' ) ] )
+		self.assertEqual( self.engine.db.find( file = 'new', dir = 'b' )[0]['hash'], get_hash( self.dest ) )
+
+	def test_changed_while_moving( self ):
+		with open( self.src, 'ab' ) as f:
+			f.write( b'more' )
+		self.move()
+		self.assertEqual( self.files(), [ ( 'b', 'new' ) ] )
+		self.assertEqual( self.engine.db.find( file = 'new', dir = 'b' )[0]['hash'], get_hash( self.dest ) )
+
+	def test_not_in_db( self ):
+		self.engine.db.remove( file = 'old', dir = 'a' )
+		self.move()
+		self.assertEqual( self.files(), [ ( 'b', 'new' ) ] )
+
+	def test_dir_moved_event( self ):
+		src, dest = os.path.join( self.root, 'a' ), os.path.join( self.root, 'c' )
+		os.rename( src, dest )
+		self.engine.on_any_event( watchdog.events.DirMovedEvent( src, dest ) )
+		self.drain()
+		self.assertEqual( self.files(), [ ( 'c', 'old' ) ] )
+		self.engine.on_any_event( watchdog.events.FileMovedEvent( self.src, os.path.join( dest, 'old' ) ) )	# Следом watchdog шлёт переезд каждого файла
+		self.engine.coalescer.flush( force = True )
+		self.drain()
+		self.assertEqual( self.files(), [ ( 'c', 'old' ) ] )
+
+
+class TestHashPool( unittest.TestCase ):
+	def test_order_and_skip( self ):
+		pool = HashPool( workers = 3, maxPending = 2 )
+		items = [ 'a', None, 'b', 'c', None ]
+		with unittest.mock.patch( 'fileutils.get_hash', side_effect = lambda x, algorithm: x.upper() ):
+			res = list( pool.imap( items ) )
+		self.assertEqual( res, [ ( 'a', 'A' ), ( None, None ), ( 'b', 'B' ), ( 'c', 'C' ), ( None, None ) ] )
+
+	def test_max_bytes( self ):
+		pool = HashPool( workers = 2, maxBytes = 10 )
+		with unittest.mock.patch( 'fileutils.get_size', return_value = 8 ):
+			with unittest.mock.patch( 'fileutils.get_hash', side_effect = lambda x, algorithm: x ):
+				self.assertEqual( list( pool.imap( [ '1', '2', '3' ] ) ), [ ( '1', '1' ), ( '2', '2' ), ( '3', '3' ) ] )
 
 
 class TestEngineTasks( EmptyEngineClass ):
@@ -111,6 +279,144 @@ class TestEngineTasks( EmptyEngineClass ):
 		self.launch_worker()
 		self.assertEqual( self.result, self.engine.db.find( file = 'filename' ) )
 
+	def test_query_pages( self ):
+		self.engine.PAGE_SIZE = 2
+		for i in range( 5 ):
+			self.engine.db.add( file = str( i ), hash = 'xxx' )
+		pages = []
+		self.engine.queue.put( ( 'query', { 'hash': 'xxx' }, pages.append ) )
+		self.engine.queue.put( ( 'query', { 'hash': 'yyy' }, pages.append ) )
+		self.launch_worker()
+		self.assertEqual( [ [ i['file'] for i in p ] for p in pages ], [ [ '0', '1' ], [ '2', '3' ], [ '4' ], [] ] )
+
+	def test_query_expression( self ):
+		self.engine.db.add( file = 'filename', hash = 'xxx', tags = { 'a', 'b' } )
+		self.engine.queue.put( ( 'query', 'a & !c', self.setResult ) )
+		self.launch_worker()
+		self.assertEqual( self.result, self.engine.db.find( file = 'filename' ) )
+
+
+class TestWorkQueue( unittest.TestCase ):
+	def test_priority_and_fifo( self ):
+		q = WorkQueue()
+		q.put( 'quit' )
+		q.put( ( 'query', 1 ) )
+		q.put( ( 'hash', 1 ) )
+		q.put( ( 'event', 1 ) )
+		q.put( ( 'event', 2 ) )
+		self.assertEqual( [ q.get() for i in range( 5 ) ], [ ( 'event', 1 ), ( 'event', 2 ), ( 'query', 1 ), ( 'hash', 1 ), 'quit' ] )
+		self.assertEqual( q.get( False ), None )
+		stats = q.stats()
+		self.assertEqual( ( stats['depth'], stats['max_depth'], stats['processed'] ), ( 0, 5, 5 ) )
+
+	def test_bounded( self ):
+		q = WorkQueue( 1 )
+		q.put( ( 'query', 1 ) )
+		t = threading.Thread( target = q.put, args = ( ( 'query', 2 ), ) )
+		t.start()
+		t.join( 0.05 )
+		self.assertTrue( t.is_alive() )
+		q.put( ( 'hash', 3 ), force = True )
+		self.assertEqual( q.qsize(), 2 )								# force кладёт задание сверх лимита
+		self.assertEqual( q.get(), ( 'query', 1 ) )
+		self.assertEqual( q.get(), ( 'hash', 3 ) )
+		t.join()
+		self.assertEqual( q.get(), ( 'query', 2 ) )
+
+	def test_reserve_for_events( self ):
+		q = WorkQueue( 2, reserve = 1 )
+		q.put( ( 'rescan', 1 ) )
+		q.put( ( 'rescan', 2 ) )
+		t = threading.Thread( target = q.put, args = ( ( 'rescan', 3 ), ) )
+		t.start()
+		t.join( 0.05 )
+		self.assertTrue( t.is_alive() )									# Фоновое задание ждёт места
+		q.put( ( 'event', 1 ) )											# А живое событие - нет
+		self.assertEqual( q.get(), ( 'event', 1 ) )
+		self.assertEqual( q.get(), ( 'rescan', 1 ) )
+		t.join()
+		self.assertEqual( q.qsize(), 2 )
+
+
+class TestThrottle( unittest.TestCase ):
+	def setUp( self ):
+		self.now = [ 0.0 ]
+		self.slept = []
+		def sleep( seconds ):
+			self.slept.append( seconds )
+			self.now[0] += seconds
+		self.bucket = TokenBucket( 100, 50, clock = lambda: self.now[0], sleep = sleep )
+		self.path = 'TEST_DIR/throttled file'
+		with open( self.path, 'wb' ) as f:
+			f.write( b'x' * ( 3 * 2**20 + 5 ) )
+
+	def tearDown( self ):
+		os.unlink( self.path )
+
+	def test_token_bucket( self ):
+		self.assertEqual( self.bucket.take( 50 ), 0.0 )					# Запас после простоя
+		self.assertEqual( self.bucket.take( 100 ), 1.0 )
+		self.now[0] += 0.5
+		self.assertEqual( self.bucket.take( 25 ), 0.0 )
+		self.assertEqual( self.bucket.take( 50 ), 0.25 )
+		self.now[0] += 100
+		self.assertEqual( self.bucket.take( 100 ), 0.5 )					# Запас не копится выше burst
+		self.assertEqual( sum( self.slept ), 1.75 )
+		self.bucket.set_rate( None )
+		self.assertEqual( self.bucket.take( 10**9 ), 0.0 )
+
+	def test_get_hash( self ):
+		self.bucket.set_rate( 2**20 )
+		with unittest.mock.patch.object( self.bucket, 'take', wraps = self.bucket.take ) as take:
+			with fileutils.throttled( self.bucket ):
+				throttled = get_hash( self.path )
+			self.assertEqual( throttled, get_hash( self.path ) )
+			self.assertEqual( sum( c.args[0] for c in take.call_args_list ), get_size( self.path ) )
+		self.assertEqual( round( self.now[0], 6 ), round( ( get_size( self.path ) - 2**20 ) / 2**20, 6 ) )	# Первый мегабайт - из запаса
+
+	def test_background_only( self ):
+		engine = Engine( bucket = self.bucket )
+		with unittest.mock.patch.object( self.bucket, 'take' ) as take:
+			engine.statAndHash( self.path )								# Живые события не ждут
+			take.assert_not_called()
+			list( engine.hashPool.imap( [ self.path ] ) )
+			take.assert_called()
+
+	def test_low_priority( self ):
+		res = []
+		t = threading.Thread( target = lambda: res.append( low_priority() ) )	# Отдельный поток: приоритет уже не вернуть
+		t.start()
+		t.join()
+		self.assertIn( res[0], ( True, False ) )
+
+	def test_monitor_shares_bucket( self ):
+		monitor = Monitor( [ 'root_1', 'root_2' ] )
+		self.assertEqual( [ e.bucket for e in monitor.engines ], [ monitor.bucket ] * 2 )
+
+
+class TestEngineWorker( EmptyEngineClass ):
+	def test_error_does_not_stop_worker( self ):
+		self.engine.db.add( file = 'filename', hash = None )
+		self.engine.db.add( file = 'filename', hash = None )
+		path = os.path.join( self.DEFAULT_CFG[0], 'filename' )
+		self.engine.queue.put( ( 'event', ( path, self.DEFAULT_CFG[0], Event.ACTION.NEW ) ) )
+		result = []
+		self.engine.queue.put( ( 'query', { 'file': 'filename' }, result.append ) )
+		with unittest.mock.patch( 'traceback.print_exc' ) as print_exc, unittest.mock.patch( 'sys.stderr' ):
+			self.drain()
+			self.assertEqual( print_exc.call_count, 1 )
+		self.assertEqual( len( result[0] ), 2 )
+
+	def test_rescan_after_live_events( self ):
+		order = []
+		rescan = os.path.join( self.DEFAULT_CFG[0], 'rescan' )
+		with unittest.mock.patch( 'main.Engine.walkPath', return_value = [ ( rescan, Event.ACTION.NEW, False, None ) ] ):
+			self.engine.updateAllInPath( self.DEFAULT_CFG[0], self.DEFAULT_CFG[0] )
+		self.engine.queue.put( ( 'event', ( 'live', self.DEFAULT_CFG[0], Event.ACTION.NEW ) ) )
+		with unittest.mock.patch( 'main.Engine.prepareEvent', side_effect = lambda p, *x: order.append( p ) or Event( None, None, None, None ) ):
+			self.drain()
+		self.assertEqual( order, [ 'live', rescan ] )
+
 
 class TestProcessEvent( EmptyEngineClass ):
 	def construct_event( self, action, d = '', isdir = False, name = 'filename' ):
@@ -229,7 +535,7 @@ class TestPrepareEvent( EmptyEngineClass ):
 		with unittest.mock.patch( 'os.path.exists', return_value = True ) as exists_test:
 			with unittest.mock.patch( 'fileutils.get_hash', return_value = 'xxx' ) as get_hash_patch:
 				newEv = self.engine.prepareEvent( ev.path, self.DEFAULT_CFG[0], ev.action )
-				get_hash_patch.assert_called_once_with( ev.path )
+				get_hash_patch.assert_called_once_with( ev.path, 'sha256' )
 				exists_test.assert_called_once_with( ev.path )
 		self.assertEqual( Event.ACTION.DUPLICATE, newEv.action )		# Файл на диске имеет такой же хэш как и файл в базе - дубликат
 		self.assertEqual( self.engine.db.find( file = 'duplicate' ), newEv.info )
@@ -317,7 +623,7 @@ class TestPrepareEvent( EmptyEngineClass ):
 			newEv = self.engine.prepareEvent( ev.path, self.DEFAULT_CFG[0], ev.action, new_path )
 			isdir_test.assert_called_once_with( ev.path )
 		self.assertEqual( Event.ACTION.RENAMED, newEv.action )	# Папка была переименована, в базе есть - нужно обновить базу
-		self.assertEqual( new_path, newEv.info )
+		self.assertEqual( get_file_and_dir( new_path, self.DEFAULT_CFG[0], True ), newEv.info )
 
 	def test_UPDATED_file_not_in_db( self ):
 		ev = Event( 'filename', '', False, self.DEFAULT_CFG[0] )
@@ -336,7 +642,7 @@ class TestPrepareEvent( EmptyEngineClass ):
 			with unittest.mock.patch( 'os.path.exists', return_value = True ) as exists_test:
 				newEv = self.engine.prepareEvent( ev.path, self.DEFAULT_CFG[0], ev.action )
 				exists_test.assert_called_once_with( ev.path )
-				hash_test.assert_called_once_with( ev.path )
+				hash_test.assert_called_once_with( ev.path, 'sha256' )
 		ev.isInDB = True
 		ev.info = 'new'
 		self.assertEqual( ev, newEv )
@@ -349,9 +655,262 @@ class TestPrepareEvent( EmptyEngineClass ):
 			with unittest.mock.patch( 'os.path.exists', return_value = True ) as exists_test:
 				newEv = self.engine.prepareEvent( ev.path, self.DEFAULT_CFG[0], ev.action )
 				exists_test.assert_called_once_with( ev.path )
-				hash_test.assert_called_once_with( ev.path )
+				hash_test.assert_called_once_with( ev.path, 'sha256' )
+		self.assertEqual( newEv.action, Event.ACTION.NOT_PROCESSING )
+
+
+class TestStatCache( EmptyEngineClass ):
+	def setUp( self ):
+		EmptyEngineClass.setUp( self )
+		self.root = os.path.abspath( 'TEST_DIR' )
+		self.path = os.path.join( self.root, 'stat file' )
+		with open( self.path, 'wb' ) as f:
+			f.write( b'data' )
+		self.engine.db.db['dir'] = self.root
+		self.engine.db.add( file = 'stat file', hash = 'cached' )
+
+	def tearDown( self ):
+		os.unlink( self.path )
+		EmptyEngineClass.tearDown( self )
+
+	def test_stat_stored( self ):
+		self.assertEqual( self.engine.db.find( file = 'stat file' )[0]['stat'], get_stat( self.path ) )
+
+	def test_unchanged_file_not_rehashed( self ):
+		with unittest.mock.patch( 'fileutils.get_hash', return_value = 'new' ) as hash_test:
+			newEv = self.engine.prepareEvent( self.path, self.root, Event.ACTION.UPDATED )
+			self.assertEqual( hash_test.call_count, 0 )
 		self.assertEqual( newEv.action, Event.ACTION.NOT_PROCESSING )
 
+	def test_changed_file_rehashed( self ):
+		with open( self.path, 'ab' ) as f:
+			f.write( b'more data' )
+		with unittest.mock.patch( 'fileutils.get_hash', return_value = 'new' ) as hash_test:
+			newEv = self.engine.prepareEvent( self.path, self.root, Event.ACTION.UPDATED )
+			hash_test.assert_called_once_with( self.path, 'sha256' )
+		self.assertEqual( newEv.action, Event.ACTION.UPDATED )
+		self.engine.processEvent( newEv )
+		self.assertEqual( self.engine.db.find( file = 'stat file' )[0]['stat'], get_stat( self.path ) )
+
+	def test_stat_taken_before_hash( self ):
+		def changing_hash( path, algorithm ):
+			with open( path, 'ab' ) as f:
+				f.write( b'written while hashing' )
+			return 'old content'
+		with open( self.path, 'ab' ) as f:
+			f.write( b'changed' )
+		with unittest.mock.patch( 'fileutils.get_hash', side_effect = changing_hash ):
+			newEv = self.engine.prepareEvent( self.path, self.root, Event.ACTION.UPDATED )
+		self.engine.processEvent( newEv )
+		self.assertNotEqual( self.engine.db.find( file = 'stat file' )[0]['stat'], get_stat( self.path ) )
+		self.assertEqual( self.engine.cachedHash( self.path, self.root ), None )
+
+	def test_stale_pool_hash( self ):										# Живое событие обогнало пересканирование, а файл уже другой
+		self.engine.hashed[self.path] = ( get_stat( self.path ), 'before change' )
+		with open( self.path, 'ab' ) as f:
+			f.write( b'changed after pool' )
+		with unittest.mock.patch( 'fileutils.get_hash', return_value = 'new' ) as hash_test:
+			newEv = self.engine.prepareEvent( self.path, self.root, Event.ACTION.UPDATED )
+			hash_test.assert_called_once_with( self.path, 'sha256' )
+		self.assertEqual( ( newEv.action, newEv.info ), ( Event.ACTION.UPDATED, 'new' ) )
+
+	def test_verify_rehashes( self ):
+		with unittest.mock.patch( 'fileutils.get_hash', return_value = 'cached' ) as hash_test:
+			self.engine.updateAllInPath( self.root, self.root )
+			self.drain()
+			self.assertEqual( hash_test.call_count, 0 )
+			self.engine.updateAllInPath( self.root, self.root, True )
+			self.drain()
+			hash_test.assert_called_once_with( self.path, 'sha256' )
+
+
+class TestStagedDuplicates( EmptyEngineClass ):
+	def setUp( self ):
+		EmptyEngineClass.setUp( self )
+		self.root = os.path.abspath( 'TEST_DIR' )
+		self.engine.cfg = [ self.root ]
+		self.engine.db.db['dir'] = self.root
+		self.files = []
+		self.old = self.write( 'old file', b'a' * 100 )
+		self.engine.db.add( file = 'old file' )
+
+	def tearDown( self ):
+		for f in self.files:
+			os.unlink( f )
+		EmptyEngineClass.tearDown( self )
+
+	def write( self, name, data ):
+		path = os.path.join( self.root, name )
+		with open( path, 'wb' ) as f:
+			f.write( data )
+		self.files.append( path )
+		return path
+
+	def prepare( self, path ):
+		with unittest.mock.patch( 'fileutils.get_hash', wraps = get_hash ) as hash_test:
+			ev = self.engine.prepareEvent( path, self.root, Event.ACTION.NEW )
+			return ev, hash_test.call_count
+
+	def test_unique_size_not_hashed( self ):
+		ev, hashed = self.prepare( self.write( 'new file', b'b' * 10 ) )
+		self.assertEqual( ( ev.action, ev.info, hashed ), ( Event.ACTION.NEW, None, 0 ) )
+		self.engine.processEvent( ev )
+		self.assertEqual( self.engine.db.find( file = 'new file' )[0]['hash'], None )
+		self.engine.queue.put( 'quit' )
+		self.engine.worker.run()
+		self.assertEqual( self.engine.db.find( file = 'new file' )[0]['hash'], get_hash( self.files[-1] ) )
+
+	def test_lazy_record_not_bad_hash( self ):
+		ev, hashed = self.prepare( self.write( 'new file', b'b' * 10 ) )
+		self.engine.processEvent( ev )
+		ev, hashed = self.prepare( self.files[-1] )
+		self.assertEqual( ev.action, Event.ACTION.NOT_PROCESSING )
+		self.assertEqual( self.engine.db.find( file = 'new file' )[0]['hash'], get_hash( self.files[-1] ) )
+
+	def test_same_size_other_sample_not_hashed( self ):
+		ev, hashed = self.prepare( self.write( 'new file', b'b' * 100 ) )
+		self.assertEqual( ( ev.action, hashed ), ( Event.ACTION.NEW, 0 ) )
+
+	def test_duplicate_with_other_algorithm( self ):
+		self.engine.hashAlgorithm = 'blake2b'
+		ev, hashed = self.prepare( self.write( 'new file', b'a' * 100 ) )
+		self.assertEqual( ev.action, Event.ACTION.DUPLICATE )
+		self.assertEqual( ev.info, self.engine.db.find( file = 'old file' ) )
+
+	def test_same_sample_hashed( self ):
+		ev, hashed = self.prepare( self.write( 'new file', b'a' * 100 ) )
+		self.assertEqual( ( ev.action, hashed ), ( Event.ACTION.DUPLICATE, 1 ) )
+		self.assertEqual( ev.info, self.engine.db.find( file = 'old file' ) )
+
+	def test_duplicate_in_other_root( self ):
+		other = Engine( shards = self.engine.shards )
+		other.db.db = deepcopy( self.DEFAULT_CFG_DB )
+		other.db.add( file = 'copy', size = 100, hash = get_hash( self.old ) )
+		self.engine.db.remove( file = 'old file' )
+		ev, hashed = self.prepare( self.write( 'new file', b'a' * 100 ) )
+		self.assertEqual( ev.action, Event.ACTION.DUPLICATE )
+		self.assertEqual( ev.info, other.db.find( file = 'copy' ) )
+
+
+class TestSimilar( EmptyEngineClass ):
+	def setUp( self ):
+		EmptyEngineClass.setUp( self )
+		self.root = os.path.abspath( 'TEST_DIR' )
+		self.engine.db.db['dir'] = self.root
+		self.path = os.path.join( self.root, 'new.png' )
+		with open( self.path, 'wb' ) as f:
+			f.write( b'new image' )
+		self.engine.db.add( file = 'old.png', size = 100, hash = 'xxx', phash = 0b1011, resolution = ( 640, 480 ) )
+
+	def tearDown( self ):
+		os.unlink( self.path )
+		EmptyEngineClass.tearDown( self )
+
+	def prepare( self, image ):
+		with unittest.mock.patch( 'phash.image_hash', return_value = image ):
+			return self.engine.prepareEvent( self.path, self.root, Event.ACTION.NEW )
+
+	def test_similar( self ):
+		ev = self.prepare( ( 0b1001, ( 320, 240 ) ) )
+		self.assertEqual( ev.action, Event.ACTION.SIMILAR )
+		self.assertEqual( ev.similar, self.engine.db.find( file = 'old.png' ) )
+		self.engine.processEvent( ev )
+		self.assertEqual( self.engine.db.find( file = 'new.png' )[0]['phash'], 0b1001 )
+		self.assertEqual( len( self.engine.db.find_similar( 0b1011, 1 ) ), 2 )
+
+	def test_found_better( self ):
+		self.assertEqual( self.prepare( ( 0b1001, ( 1280, 960 ) ) ).action, Event.ACTION.FOUND_BETTER )
+
+	def test_not_similar( self ):
+		ev = self.prepare( ( 0b1011 ^ ( 2**64 - 1 ), ( 1280, 960 ) ) )
+		self.assertEqual( ( ev.action, ev.similar ), ( Event.ACTION.NEW, None ) )
+		self.assertEqual( self.prepare( ( None, None ) ).action, Event.ACTION.NEW )
+
+
+class TestPerceptualHash( unittest.TestCase ):
+	def test_dhash( self ):
+		grid = [ list( range( 9, 0, -1 ) ) ] * 8							# Яркость убывает слева направо - все биты 1
+		self.assertEqual( phash.dhash( grid ), 2**64 - 1 )
+		self.assertEqual( phash.dhash( [ list( range( 9 ) ) ] * 8 ), 0 )
+		grids = [ [ [ ( x * 7 + y * 3 + n ) % 11 for x in range( 9 ) ] for y in range( 8 ) ] for n in range( 5 ) ]
+		self.assertEqual( phash.dhash_batch( grids ), [ phash.dhash( g ) for g in grids ] )
+
+	def test_not_image( self ):
+		self.assertEqual( phash.hash_many( [ 'TEST_DIR/no_such.txt', 'TEST_DIR/no_such.png' ] ), [ ( None, None ) ] * 2 )
+
+	def test_bk_tree( self ):
+		tree = phash.BKTree()
+		keys = [ ( i * 2654435761 ) % 2**16 for i in range( 300 ) ]
+		for n, k in enumerate( keys ):
+			tree.add( k, n )
+		for key in keys[:20]:
+			brute = sorted( ( phash.hamming( key, k ), n ) for n, k in enumerate( keys ) if phash.hamming( key, k ) <= 3 )
+			self.assertEqual( tree.search( key, 3 ), brute )
+		tree.remove( keys[0], 0 )
+		self.assertNotIn( ( 0, 0 ), tree.search( keys[0], 0 ) )
+
+
+class TestCoalescer( unittest.TestCase ):
+	def setUp( self ):
+		self.now = 0
+		self.events = []
+		self.c = Coalescer( lambda *x: self.events.append( x ), 1.0, lambda: self.now )
+
+	def test_quiet_period( self ):
+		self.c.push( Coalescer.CREATED, 'a' )
+		for i in range( 10 ):
+			self.c.push( Coalescer.MODIFIED, 'a' )
+		self.assertEqual( self.c.flush( 0.5 ), 0 )
+		self.assertEqual( self.c.flush( 1.5 ), 1 )
+		self.assertEqual( self.events, [ ( Coalescer.CREATED, 'a', None ) ] )
+
+	def test_created_deleted( self ):
+		self.c.push( Coalescer.CREATED, 'a' )
+		self.c.push( Coalescer.DELETED, 'a' )
+		self.assertEqual( self.c.flush( 10 ), 0 )
+
+	def test_created_moved( self ):
+		self.c.push( Coalescer.CREATED, 'a' )
+		self.c.push( Coalescer.MOVED, 'a', 'b' )
+		self.c.push( Coalescer.MODIFIED, 'b' )
+		self.c.flush( 10 )
+		self.assertEqual( self.events, [ ( Coalescer.CREATED, 'b', None ) ] )
+
+	def test_moved_modified( self ):
+		self.c.push( Coalescer.MOVED, 'a', 'b' )
+		self.c.push( Coalescer.MOVED, 'b', 'c' )
+		self.c.push( Coalescer.MODIFIED, 'c' )
+		self.c.flush( 10 )
+		self.assertEqual( self.events, [ ( Coalescer.MOVED, 'a', 'c' ), ( Coalescer.MODIFIED, 'c', None ) ] )
+
+	def test_still_writing( self ):
+		stats = iter( [ ( 1, ), ( 2, ), ( 2, ) ] )
+		with unittest.mock.patch( 'fileutils.get_stat', side_effect = lambda x: next( stats ) ):
+			self.c.push( Coalescer.CREATED, 'a' )
+			self.assertEqual( self.c.flush( 2 ), 0 )
+			self.assertEqual( self.c.flush( 3.5 ), 1 )
+
+
+class TestEngineEvents( EmptyEngineClass ):
+	def test_events_coalesced( self ):
+		path = os.path.join( self.DEFAULT_CFG[0], 'filename' )
+		with unittest.mock.patch( 'main.Engine.prepareEvent', return_value = Event( None, None, None, None ) ) as p:
+			self.engine.on_any_event( watchdog.events.FileCreatedEvent( path ) )
+			for i in range( 5 ):
+				self.engine.on_any_event( watchdog.events.FileModifiedEvent( path ) )
+			self.engine.coalescer.flush( force = True )
+			self.assertEqual( p.call_count, 0 )
+			self.engine.queue.put( 'quit' )
+			self.engine.worker.run()
+			p.assert_called_once_with( path, self.DEFAULT_CFG[0], Event.ACTION.NEW, None )
+
+	def test_ignored( self ):
+		path = os.path.join( self.DEFAULT_CFG[0], 'filename' )
+		self.engine.ignoreFiles.append( path )
+		self.engine.on_any_event( watchdog.events.FileDeletedEvent( path ) )
+		self.assertEqual( self.engine.coalescer.pending, {} )
+		self.assertEqual( self.engine.ignoreFiles, [] )
+
 
 class TestEngineCfg( unittest.TestCase ):
 	def setUp( self ):
@@ -366,6 +925,131 @@ class TestEngineCfg( unittest.TestCase ):
 		os.unlink( 'TEST_DIR/test_cfg_2' )
 
 
+class TestAsyncEngine( unittest.TestCase ):
+	def setUp( self ):
+		self.root = os.path.abspath( 'TEST_DIR' )
+		self.path = os.path.join( self.root, 'async file' )
+		with open( self.path, 'wb' ) as f:
+			f.write( b'async' )
+		self.front = AsyncEngine( cfg = [ self.root ] )
+		self.engine = self.front.engine
+		self.engine.db.db['dir'] = self.root
+		self.engine.worker.start()
+
+	def tearDown( self ):
+		self.engine.queue.put( 'quit' )
+		self.engine.worker.join()
+		os.unlink( self.path )
+
+	def test_add_find_remove( self ):
+		async def run():
+			with unittest.mock.patch( 'fileutils.get_hash', wraps = get_hash ) as hash_test:
+				await self.front.add( file = 'async file' )
+				hash_test.assert_called_once_with( self.path, 'sha256' )
+			self.assertEqual( self.engine.db.find( file = 'async file' )[0]['hash'], get_hash( self.path ) )
+			res = await self.front.find( file = 'async file' )
+			self.assertEqual( res, self.engine.db.find( file = 'async file' ) )
+			self.assertEqual( await self.front.query( 'Unsorted & size=5' ), res )
+			await self.front.remove( file = 'async file' )
+			self.assertEqual( await self.front.find( file = 'async file' ), [] )
+		asyncio.run( run() )
+
+	def test_error_raised( self ):
+		async def run():
+			with self.assertRaises( NameError ):
+				await self.front.add( flags = { 'lazy': True }, dir = '' )
+		asyncio.run( run() )
+
+	def test_events( self ):
+		async def run():
+			events = self.front.events()
+			first = asyncio.ensure_future( events.__anext__() )
+			await asyncio.sleep( 0 )
+			self.engine.queue.put( ( 'event', ( self.path, self.root, Event.ACTION.NEW ) ) )
+			ev = await asyncio.wait_for( first, 5 )
+			await events.aclose()
+			return ev
+		ev = asyncio.run( run() )
+		self.assertEqual( ( ev.action, ev.fileName ), ( Event.ACTION.NEW, 'async file' ) )
+		self.assertEqual( self.front.subscribers, [] )
+
+
+class TestMonitor( unittest.TestCase ):
+	def test_engine_per_root( self ):
+		monitor = Monitor( [ 'root_1', 'root_2' ] )
+		self.assertEqual( [ e.cfg for e in monitor.engines ], [ [ 'root_1' ], [ 'root_2' ] ] )
+		self.assertEqual( [ e.shards for e in monitor.engines ], [ monitor.shards ] * 2 )
+		self.assertEqual( monitor.shards.shards, [ e.db for e in monitor.engines ] )
+		self.assertEqual( monitor.dbName( 0, 'root_1' ), Engine.DEFAULT_DB_NAME )
+		self.assertNotEqual( monitor.dbName( 1, 'root_2' ), monitor.dbName( 2, 'root_3' ) )
+
+	def test_legacy_import_once( self ):									# Старый pickle попадает только в базу своего корня
+		legacy = 'TEST_DIR/legacy_db'
+		dump_pickle( { 'dir': 'root_2', 'tags': {}, 'media': [ { 'file': 'legacy.jpg', 'dir': '', 'hash': 'xxx', 'size': 1 } ] }, legacy )
+		monitor = Monitor( [ 'root_1', 'root_2' ] )
+		self.assertEqual( monitor.legacyShard( legacy ), 1 )
+		for n, engine in enumerate( monitor.engines ):
+			engine.db.load_db( legacy, legacy = n == monitor.legacyShard( legacy ) )
+		self.assertEqual( [ i['file'] for i in monitor.find( hash = 'xxx' ) ], [ 'legacy.jpg' ] )
+		self.assertEqual( len( monitor.engines[0].db.db['media'] ), 0 )
+		dump_pickle( { 'dir': 'elsewhere', 'tags': {}, 'media': [] }, legacy )
+		self.assertEqual( monitor.legacyShard( legacy ), 0 )
+		os.unlink( legacy )
+		self.assertEqual( monitor.legacyShard( legacy ), None )
+
+
+class TestMetrics( unittest.TestCase ):
+	def setUp( self ):
+		metrics.METRICS.reset()
+
+	def test_snapshot( self ):
+		m = metrics.Metrics()
+		m.count( 'a' )
+		m.count( 'a', 2 )
+		m.gauge( 'depth', 5 )
+		m.observe( 't', 1.0 )
+		m.observe( 't', 3.0 )
+		self.assertEqual( m.snapshot(), { 'a': 3, 'depth': 5, 't_count': 2, 't_seconds_total': 4.0, 't_seconds_max': 3.0 } )
+
+	def test_hot_path( self ):
+		with open( 'TEST_DIR/metrics file', 'wb' ) as f:
+			f.write( b'x' * 1000 )
+		get_hash( 'TEST_DIR/metrics file' )
+		os.unlink( 'TEST_DIR/metrics file' )
+		db = DataBase()
+		db.db = { 'dir': 'TEST_DIR', 'tags': {}, 'media': [ { 'file': str( i ), 'dir': '', 'size': i % 2 } for i in range( 10 ) ] }
+		db.find( size = 1 )
+		engine = Engine()
+		with unittest.mock.patch( 'builtins.print' ) as print_test:
+			engine.on_any_event( watchdog.events.FileCreatedEvent( 'TEST_DIR/metrics file' ) )
+			print_test.assert_not_called()
+		snapshot = metrics.METRICS.snapshot()
+		self.assertEqual( ( snapshot['hash_bytes'], snapshot['hash_count'] ), ( 1000, 1 ) )
+		self.assertEqual( ( snapshot['find_scanned'], snapshot['find_returned'], snapshot['find_count'] ), ( 5, 5, 1 ) )
+		self.assertEqual( snapshot['events_received'], 1 )
+
+	def test_sinks( self ):
+		metrics.METRICS.count( 'events_received', 3 )
+		fileName = 'TEST_DIR/metrics.prom'
+		metrics.PrometheusFileSink( fileName )( metrics.METRICS.snapshot() )
+		with open( fileName ) as f:
+			self.assertEqual( f.read(), 'pymediamonitor_events_received 3\n' )
+		os.unlink( fileName )
+		with self.assertLogs( 'pyMediaMonitor.metrics', 'INFO' ) as log:
+			metrics.LogSink()( metrics.METRICS.snapshot() )
+		self.assertIn( 'events_received=3', log.output[0] )
+
+
+class TestBench( unittest.TestCase ):
+	def test_run( self ):
+		res = json.loads( json.dumps( bench.run( records = 200, files = 10, queries = 20 ) ) )
+		self.assertEqual( res['database']['find_hash']['ops'], 20 )
+		self.assertEqual( res['engine']['bulk_copy']['records'], 10 )
+		self.assertEqual( res['engine']['mass_delete']['records'], 0 )
+		for k in ( 'ops_per_sec', 'p50_ms', 'p99_ms' ):
+			self.assertIn( k, res['get_hash'] )
+
+
 class TestFileUtils( unittest.TestCase ):
 	testData = b'12345689abcdefghijklmnopqrsuvwxyz_'
 
@@ -382,6 +1066,18 @@ class TestFileUtils( unittest.TestCase ):
 	def test_get_hash( self ):
 		self.assertEqual( get_hash( 'TEST_DIR/tmp file' ), 'bf5c8c903440047e4bcd6f532b8d662a46144b7709e9c633734fd8c127df8c17' )
 
+	def test_get_hash_algorithm( self ):
+		h = get_hash( 'TEST_DIR/tmp file', 'blake2b' )
+		self.assertEqual( h, 'blake2b:' + hashlib.blake2b( self.testData ).hexdigest() )
+		self.assertEqual( hash_algorithm( h ), 'blake2b' )
+		self.assertEqual( hash_algorithm( get_hash( 'TEST_DIR/tmp file' ) ), 'sha256' )
+
+	def test_get_hash_big_file( self ):
+		data = os.urandom( 3 * 2**20 + 17 )
+		with open( 'TEST_DIR/tmp file', 'wb' ) as f:
+			f.write( data )
+		self.assertEqual( get_hash( 'TEST_DIR/tmp file' ), hashlib.sha256( data ).hexdigest() )
+
 	def test_get_created( self ):
 		self.assertTrue( get_created( 'TEST_DIR/tmp file' ) - int( time.time() ) < 60 )			# Винда как-то косячит, поэтому время создания немного отстаёт. (кэш?)
 
@@ -458,6 +1154,99 @@ class TestDB( unittest.TestCase ):
 	def test_find_tags( self ):
 		self.assertEqual( self.db.find( tags = {'test  tag 2'} ), [ self.dbData['media'][1], self.dbData['media'][2] ] )
 		
+	def test_query( self ):
+		media = self.dbData['media']
+		self.assertEqual( self.db.query( "'test  tag 2'" ), [ media[1], media[2] ] )
+		self.assertEqual( self.db.query( "'test  tag 2' & !test_tag_1" ), [ media[2] ] )
+		self.assertEqual( self.db.query( "test_tag_1 or 'test!/|-@ tag    3'" ), [ media[0], media[1] ] )
+		self.assertEqual( self.db.query( "'тест тэг 4' and not ( test_tag_1 | 'test  tag 2' )" ), [ media[0], media[3] ] )
+		self.assertEqual( self.db.query( "!'тест тэг 4'" ), [] )
+
+	def test_query_fields( self ):
+		media = self.dbData['media']
+		self.assertEqual( self.db.query( "'тест тэг 4' & size=5784745" ), [ media[2], media[3] ] )
+		self.assertEqual( self.db.query( "size>600000 & google~'celestia'" ), [ media[2] ] )
+		self.assertEqual( self.db.query( "google=None | created<1389078960" ), [ media[3] ] )
+		self.assertEqual( self.db.query( ( 'field', 'dir', '=', 'unknown dir' ) ), [ media[3] ] )
+
+	def test_query_smallest_first( self ):
+		with unittest.mock.patch.object( self.db, '_test', wraps = self.db._test ) as test:
+			self.assertEqual( self.db.query( "google~'cake' & 'test!/|-@ tag    3'" ), [ self.dbData['media'][0] ] )
+			self.assertEqual( test.call_count, 1 )						# Перебор только внутри единственной записи с тэгом
+
+	def test_lazy_find( self ):
+		media = self.dbData['media']
+		with unittest.mock.patch.object( self.db, '_match', wraps = self.db._match ) as match:
+			cursor = self.db.iter_find( google = None )
+			self.assertEqual( match.call_count, 0 )
+			self.assertEqual( next( cursor ), media[3] )
+			self.assertEqual( match.call_count, 4 )
+			match.reset_mock()
+			self.assertEqual( self.db.first( tags = { 'тест тэг 4' } ), media[0] )
+			self.assertEqual( match.call_count, 1 )
+		self.assertEqual( self.db.find( { 'limit': 2 }, tags = { 'тест тэг 4' } ), media[:2] )
+		self.assertEqual( self.db.count( tags = { 'тест тэг 4' } ), 4 )
+		self.assertEqual( ( self.db.exists( file = '2.jpg' ), self.db.exists( file = 'no.jpg' ) ), ( True, False ) )
+		self.assertEqual( self.db.first( file = 'no.jpg' ), None )
+
+	def test_cursor_snapshot( self ):
+		cursor = self.db.iter_find( flags = { 're': True }, file = r'\.' )
+		first = next( cursor )
+		self.db.remove( file = '2.jpg' )
+		self.assertEqual( [ first['file'] ] + [ i['file'] for i in cursor ], [ '1.jpg', '2.jpg', '3.jpg', self.dbData['media'][3]['file'] ] )
+
+	def test_rename_dir( self ):
+		media = self.dbData['media']
+		self.db.find( { 're': True }, dir = '^r' )						# Строим отсортированный индекс имён
+		with unittest.mock.patch.object( self.db, 'update' ) as update_test:
+			self.assertEqual( self.db.rename_dir( 'test_content', 'renamed' ), 1 )
+			update_test.assert_not_called()
+		self.assertEqual( self.db.find( dir = 'test_content' ), [] )
+		self.assertEqual( self.db.find( file = '1.jpg', dir = 'renamed' ), [ dict( media[0], dir = 'renamed' ) ] )
+		self.assertEqual( self.db.find( { 're': True }, dir = '^re' ), [ dict( media[0], dir = 'renamed' ) ] )
+		self.assertIn( ( 'renamed', '1.jpg' ), self.db.paths() )
+		self.assertEqual( self.db._sortedNames['dir'], sorted( self.db._nameIndex['dir'] ) )
+		self.assertEqual( self.db.rename_dir( 'no such dir', 'x' ), 0 )
+
+	def test_rename_dir_merge( self ):
+		self.assertEqual( self.db.rename_dir( 'test content 2', 'unknown dir' ), 1 )
+		self.assertEqual( [ i['file'] for i in self.db.find( dir = 'unknown dir' ) ], [ '2.jpg', self.dbData['media'][3]['file'] ] )
+		self.assertNotIn( 'test content 2', self.db._dirs )
+		self.assertEqual( self.db._dirs['unknown dir'].count, 2 )
+
+	def test_regex_prefix( self ):
+		for pattern, prefix in ( ( '^test', 'test' ), ( r'^test\ c', 'test c' ), ( '^tes?t', 'te' ), ( '^a+b', 'a' ),
+								 ( r'^\d', '' ), ( 'test', '' ), ( '^a|b', '' ), ( '^т.ст', 'т' ) ):
+			self.assertEqual( DataBase._regex( pattern )[1], prefix, pattern )
+
+	def test_find_regex_prefix( self ):
+		media = self.dbData['media']
+		flags = { 're': True }
+		with unittest.mock.patch.object( self.db, '_match', wraps = self.db._match ) as match:
+			self.assertEqual( self.db.find( flags, dir = '^test' ), [ media[0], media[1] ] )
+			self.assertEqual( match.call_count, 2 )
+		self.db.add( file = 'new.jpg', dir = 'test new', size = 1, created = 1, hash = 'a' )
+		self.db.remove( file = '1.jpg' )
+		self.db.update( { 'file': '3.jpg', 'dir': 'тест контент 3' }, { 'dir': 'test 3' } )
+		self.assertEqual( [ i['file'] for i in self.db.find( flags, dir = '^test' ) ], [ '2.jpg', '3.jpg', 'new.jpg' ] )
+		self.assertEqual( self.db._sortedNames['dir'], sorted( self.db._nameIndex['dir'] ) )
+		self.assertEqual( self.db.find( flags, dir = '^test', file = '^2' ), [ media[1] ] )
+
+	def test_regex_compiled_once( self ):
+		DataBase._regex.cache_clear()
+		with unittest.mock.patch( 're.compile', wraps = re.compile ) as compile_test:
+			for i in range( 3 ):
+				self.db.find( { 're': True }, url = r'\.net/' )
+			self.assertEqual( compile_test.call_count, 1 )
+
+	def test_query_parse( self ):
+		self.assertEqual( tagquery.parse( 'a & ( b | !"c d" )' ),
+						  ( 'and', [ ( 'tag', 'a' ), ( 'or', [ ( 'tag', 'b' ), ( 'not', ( 'tag', 'c d' ) ) ] ) ] ) )
+		self.assertEqual( tagquery.parse( "size>10 or file~'\\.png$'" ),
+						  ( 'or', [ ( 'field', 'size', '>', 10 ), ( 'field', 'file', '~', '\\.png$' ) ] ) )
+		for bad in ( 'a &', '( a', 'a b', 'size=' ):
+			self.assertRaises( ValueError, tagquery.parse, bad )
+
 	def test_find_url_regex( self ):
 		self.assertEqual( self.db.find( url = r'\.net/', flags = {'re': True} ), [ self.dbData['media'][1], self.dbData['media'][2] ] )
 		
@@ -499,6 +1288,35 @@ class TestDB( unittest.TestCase ):
 		self.assertEqual( self.db.db['tags']['тест тэг 4'], self.dbData['tags']['тест тэг 4'] - 1 )
 		self.assertNotIn( 'test!/|-@ tag    3', self.db.db['tags'].keys() )
 
+	def test_add_many( self ):
+		count = self.db.add_many( [ { 'file': 'a', 'hash': 'xxx' }, { 'file': 'b', 'tags': {'test_tag_1'} }, { 'file': 'c', 'dir': 'd' } ] )
+		self.assertEqual( count, 3 )
+		self.assertEqual( self.db.db['tags']['Unsorted'], 2 )
+		self.assertEqual( self.db.db['tags']['test_tag_1'], self.dbData['tags']['test_tag_1'] + 1 )
+		self.assertEqual( len( self.db.find( hash = 'xxx' ) ), 1 )
+		self.assertEqual( len( self.db.find( file = 'c', dir = 'd' ) ), 1 )
+		with self.assertRaises( NameError ):
+			self.db.add_many( [ { 'file': 'e' }, { 'dir': 'no file' } ] )
+		self.assertEqual( self.db.find( file = 'e' ), [] )
+
+	def test_update_many( self ):
+		self.db.update_many( [ ( {'file': '1.jpg', 'dir': 'test_content'}, {'hash': 'a'} ),
+							   ( {'file': '2.jpg', 'dir': 'test content 2'}, {'hash': 'b'} ) ] )
+		self.assertEqual( [ i['file'] for i in self.db.find( hash = 'a' ) + self.db.find( hash = 'b' ) ], [ '1.jpg', '2.jpg' ] )
+
+	def test_remove_many( self ):
+		count = self.db.remove_many( [ {'file': '1.jpg'}, {'dir': 'test content 2'}, {'file': '1.jpg'} ] )
+		self.assertEqual( count, 2 )
+		self.assertEqual( self.db.db['media'], self.dbData['media'][2:] )
+		self.assertEqual( self.db.db['tags']['тест тэг 4'], self.dbData['tags']['тест тэг 4'] - 2 )
+		self.assertNotIn( 'test_tag_1', self.db.db['tags'] )
+		self.assertEqual( self.db.db['tags']['test  tag 2'], 1 )
+
+	def test_remove_keeps_other_records( self ):
+		self.db.remove( dir = 'test content 2' )
+		self.assertEqual( self.db.db['media'], [ self.dbData['media'][0] ] + self.dbData['media'][2:] )
+		self.assertEqual( self.db.remove( file = 'no_file' ), 0 )
+
 	def test_update_file( self ):
 		self.db.add( file = 'filename', hash = 'xxx' )
 		self.db.update( {'file': 'filename'}, {'file': 'new_filename', 'hash': 'new'} )
@@ -515,6 +1333,23 @@ class TestDB( unittest.TestCase ):
 		self.assertEqual( len( self.db.find( dir = 'dir' ) ), 0 )
 		self.assertEqual( len( elem ), 2 )
 
+	def test_find_path_index( self ):
+		self.db.add( file = 'filename', dir = 'dir', hash = 'xxx' )
+		self.db.add( file = 'filename', dir = 'dir_2', hash = 'xxx' )
+		self.assertEqual( len( self.db.find( file = 'filename', dir = 'dir' ) ), 1 )
+		self.assertEqual( len( self.db.find( hash = 'xxx' ) ), 2 )
+		self.assertEqual( self.db.find( file = 'filename', dir = 'dir', hash = 'yyy' ), [] )
+
+	def test_index_after_update_and_remove( self ):
+		self.db.add( file = 'filename', dir = 'dir', hash = 'xxx', tags = {'tag'} )
+		self.db.update( {'file': 'filename', 'dir': 'dir'}, {'dir': 'new_dir', 'hash': 'new'} )
+		self.assertEqual( self.db.find( file = 'filename', dir = 'dir' ), [] )
+		self.assertEqual( self.db.find( hash = 'xxx' ), [] )
+		self.assertEqual( len( self.db.find( file = 'filename', dir = 'new_dir', hash = 'new' ) ), 1 )
+		self.db.remove( file = 'filename' )
+		self.assertEqual( self.db.find( hash = 'new' ), [] )
+		self.assertEqual( self.db.find( tags = {'tag'} ), [] )
+
 	def test_re_flag( self ):
 		elem = self.db.find( file = '.jpg', flags = { 're': True })
 		self.assertEqual( len( elem ), 3 )
@@ -523,5 +1358,325 @@ class TestDB( unittest.TestCase ):
 		elem = self.db.find( file = '.jpg' )
 		self.assertEqual( len( elem ), 0 )
 
+class TestRecord( unittest.TestCase ):
+	data = { 'file': '1.jpg', 'dir': 'dir', 'size': 1, 'created': 1, 'hash': 'ab' * 32, 'tags': { 'Unsorted' },
+			 'url': None, 'google': None }
+
+	def test_dict_compatible( self ):
+		record = Record( self.data )
+		self.assertEqual( record, self.data )
+		self.assertEqual( self.data, record )
+		self.assertEqual( dict( record ), self.data )
+		self.assertEqual( record.get( 'stat' ), None )
+		self.assertRaises( KeyError, lambda: record['stat'] )
+		record.update( { 'stat': ( 1, 2 ), 'custom': 'x' } )
+		self.assertEqual( ( record['stat'], record['custom'], len( record ) ), ( ( 1, 2 ), 'x', 10 ) )
+		del record['custom']
+		self.assertNotIn( 'custom', record )
+
+	def test_compact( self ):
+		record, other = Record( self.data ), Record( dict( self.data, dir = ''.join( [ 'd', 'ir' ] ) ) )
+		self.assertEqual( record.raw( 'hash' ), b'\xab' * 32 )
+		self.assertIs( record.tags, other.tags )
+		self.assertIs( record.dir, other.dir )
+		self.assertEqual( Record( { 'hash': 'blake2b:' + 'ab' * 32 } ).raw( 'hash' ), ( 'blake2b', b'\xab' * 32 ) )
+		for h in ( 'blake2b:' + 'ab' * 32, 'AB', 'xxx', None ):
+			self.assertEqual( Record( { 'hash': h } )['hash'], h )
+
+	def test_copy( self ):
+		record = Record( self.data )
+		self.assertEqual( pickle.loads( pickle.dumps( record ) ), self.data )
+		self.assertEqual( deepcopy( record ), self.data )
+		self.assertIs( type( deepcopy( record ) ), Record )
+
+	def test_database_records( self ):
+		db = DataBase()
+		db.db = { 'dir': 'TEST_DIR', 'tags': {}, 'media': [ dict( self.data ) ] }
+		self.assertIs( type( db.db['media'][0] ), Record )
+		self.assertEqual( db.find( hash = 'ab' * 32 ), [ self.data ] )
+		db.update( { 'file': '1.jpg', 'dir': 'dir' }, { 'hash': 'cd' * 32 } )
+		self.assertEqual( db.find( hash = 'ab' * 32 ), [] )
+		self.assertEqual( db.find( hash = 'cd' * 32 )[0]['file'], '1.jpg' )
+
+
+class HookLock:																# Блокировка, которая на n-м захвате выполняет hook
+	def __init__( self, lock, n, hook ):
+		self.lock, self.n, self.hook = lock, n, hook
+
+	def __enter__( self ):
+		self.lock.acquire()
+		self.n -= 1
+		if self.n == 0:
+			self.hook()
+
+	def __exit__( self, *args ):
+		self.lock.release()
+
+
+class TestSnapshot( unittest.TestCase ):
+	fileName = 'TEST_DIR/test_snapshot'
+
+	def setUp( self ):
+		self.db = DataBase()
+		self.db.db = deepcopy( TestDB.dbData )
+		self.expected = deepcopy( self.db.db )
+
+	def tearDown( self ):
+		if os.path.exists( self.fileName ):
+			os.unlink( self.fileName )
+
+	def change( self ):
+		self.db.update( { 'file': '2.jpg', 'dir': 'test content 2' }, { 'google': 'changed' } )
+		self.db.rename_dir( 'тест контент 3', 'renamed' )
+		self.db.add( file = 'new.jpg', size = 1, created = 1, hash = 'a' )
+		self.db.remove( file = self.expected['media'][3]['file'] )
+
+	def test_consistent_view( self ):
+		self.db.lock = HookLock( self.db.lock, 3, self.change )			# Изменения - посреди снимка
+		snapshot = self.db.snapshot( chunk = 1 )
+		self.assertEqual( snapshot, self.expected )
+		self.assertEqual( self.db.find( file = '2.jpg' )[0]['google'], 'changed' )
+		self.assertEqual( self.db._cow, None )
+		self.assertEqual( self.db.dirty, 4 )
+
+	def test_snapshotter( self ):
+		now = [ 0.0 ]
+		snapshotter = Snapshotter( self.db, self.fileName, interval = 10, dirtyThreshold = 3, clock = lambda: now[0] )
+		self.assertFalse( snapshotter.due() )
+		self.db.update( { 'file': '2.jpg', 'dir': 'test content 2' }, { 'google': 'changed' } )
+		self.assertFalse( snapshotter.due() )
+		now[0] = 10.0
+		self.assertTrue( snapshotter.due() )
+		self.assertEqual( snapshotter.snapshot(), 4 )
+		self.assertFalse( snapshotter.due() )
+		self.assertEqual( load_pickle( self.fileName )['media'][1]['google'], 'changed' )
+		self.assertFalse( os.path.exists( self.fileName + '.tmp' ) )
+		self.change()
+		self.assertTrue( snapshotter.due() )								# Порог изменений - без ожидания
+		snapshotter.stop()
+		self.assertEqual( len( load_pickle( self.fileName )['media'] ), 4 )
+		self.assertEqual( self.db.dirty, 0 )
+
+	def test_trigger( self ):
+		snapshotter = Snapshotter( self.db, self.fileName )
+		snapshotter.CHECK_EVERY = 0.01
+		snapshotter.start()
+		snapshotter.trigger()												# Изменений нет, но снимок попросили
+		for i in range( 200 ):
+			if not snapshotter.requested.is_set() and os.path.exists( self.fileName ):
+				break
+			time.sleep( 0.01 )
+		snapshotter.stop()
+		self.assertEqual( len( load_pickle( self.fileName )['media'] ), 4 )
+		self.assertFalse( snapshotter.requested.is_set() )
+
+
+class TestChunkIndex( unittest.TestCase ):
+	SIZES = { 'bits': 12, 'minSize': 2**12, 'maxSize': 2**15 }			# Маленькие куски, чтобы хватило файла в 1 МБ
+
+	def setUp( self ):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join( self.dir, 'video.bin' )
+		self.data = random.Random( 1 ).randbytes( 2**20 )
+		self.write( self.data )
+		self.index = ChunkIndex( **self.SIZES )
+		metrics.METRICS.reset()
+
+	def tearDown( self ):
+		self.index.close()
+		shutil.rmtree( self.dir )
+
+	def write( self, data, path = None ):
+		with open( path or self.path, 'wb' ) as f:
+			f.write( data )
+
+	def fresh( self ):
+		with open( self.path, 'rb' ) as f:
+			return list( fileutils.iter_chunks( f, 0, **self.SIZES ) )
+
+	def test_boundaries_follow_content( self ):
+		chunks = self.fresh()
+		self.assertEqual( sum( c[1] for c in chunks ), len( self.data ) )
+		self.assertTrue( all( c[0] + c[1] == n[0] for c, n in zip( chunks, chunks[1:] ) ) )
+		self.assertTrue( all( c[1] <= 2**15 for c in chunks ) and all( c[1] >= 2**12 for c in chunks[:-1] ) )
+		self.write( b'inserted' + self.data )								# Сдвиг всех данных меняет только первый кусок
+		shifted = self.fresh()
+		self.assertGreaterEqual( len( { c[2] for c in chunks } & { c[2] for c in shifted } ), len( chunks ) - 2 )
+
+	@unittest.skipIf( fileutils.numpy == None, 'нужен NumPy' )
+	def test_numpy_matches_python( self ):									# Индексы, посчитанные с NumPy и без него, должны совпадать
+		with_numpy = self.fresh()
+		with unittest.mock.patch( 'fileutils.numpy', None ):
+			self.assertEqual( self.fresh(), with_numpy )
+		data = self.data[:2**16]
+		for start in ( 64, 100, 4096 ):
+			cuts = [ fileutils._find_cut( data, start, len( data ), 2**6 - 1 ) ]
+			with unittest.mock.patch( 'fileutils.numpy', None ):
+				cuts.append( fileutils._find_cut( data, start, len( data ), 2**6 - 1 ) )
+			self.assertEqual( cuts[0], cuts[1] )
+
+	def test_modified_file( self ):
+		self.assertEqual( [ tuple( c ) for c in self.index.index( self.path ) ], self.fresh() )
+		self.assertEqual( metrics.METRICS.snapshot()['chunk_rolled_bytes'], len( self.data ) )
+		self.assertEqual( self.index.index( self.path ), self.index.chunks( self.path ) )		# Файл не менялся - ничего не читается
+		self.assertEqual( metrics.METRICS.snapshot()['chunk_rolled_bytes'], len( self.data ) )
+		metrics.METRICS.reset()
+		self.write( self.data[:500000] + b'changed' + self.data[500000:] )
+		self.assertEqual( [ tuple( c ) for c in self.index.index( self.path ) ], self.fresh() )
+		stats = metrics.METRICS.snapshot()
+		self.assertLess( stats['chunk_rolled_bytes'], 3 * 2**15 )
+		self.assertEqual( stats['chunk_rolled_bytes'] + stats['chunk_verified_bytes'], len( self.data ) + 7 )
+
+	def test_resume( self ):
+		self.assertEqual( self.index.index( self.path, limit = 2**18 ), None )
+		self.assertTrue( self.index.unfinished( self.path ) )
+		self.assertEqual( self.index.pending(), [ self.path ] )
+		while self.index.index( self.path, limit = 2**18 ) == None:
+			pass
+		self.assertFalse( self.index.unfinished( self.path ) )
+		self.assertEqual( [ tuple( c ) for c in self.index.chunks( self.path ) ], self.fresh() )
+		self.assertEqual( metrics.METRICS.snapshot()['chunk_rolled_bytes'], len( self.data ) )	# Ничего не посчитано дважды
+
+	def test_shared( self ):
+		other = os.path.join( self.dir, 'clip.bin' )
+		self.write( self.data[:2**19], other )
+		self.index.index( self.path )
+		self.index.index( other )
+		( path, ratio ), = self.index.shared( self.path )
+		self.assertEqual( path, other )
+		self.assertTrue( 0.4 < ratio < 0.5 )
+		self.assertGreater( self.index.shared( other )[0][1], 0.9 )
+		self.index.rename( self.dir, self.dir + '_renamed' )
+		self.assertEqual( self.index.shared( os.path.join( self.dir + '_renamed', 'clip.bin' ) )[0][0],
+						  os.path.join( self.dir + '_renamed', 'video.bin' ) )
+		self.index.forget( os.path.join( self.dir + '_renamed', 'video.bin' ) )
+		self.assertEqual( self.index.shared( os.path.join( self.dir + '_renamed', 'clip.bin' ) ), [] )
+
+	def test_engine( self ):
+		engine = Engine()
+		engine.chunks = self.index
+		engine.CHUNK_MIN_FILE = 2**20
+		engine.queueChunks( self.path )
+		engine.queueChunks( os.path.join( self.dir, 'missing.bin' ) )
+		self.assertEqual( engine.chunkQueue.get( False ), ( 'chunk', self.path ) )
+		self.assertEqual( engine.chunkQueue.get( False ), None )
+		self.assertEqual( engine.sharedContent( self.path ), [] )
+		engine.CHUNK_STEP = 2**18
+		engine.queueChunks( self.path )
+		engine.chunkQueue.put( 'quit' )
+		engine.chunker.start()												# Шагами по CHUNK_STEP, пока файл не посчитан целиком
+		engine.chunker.join()
+		self.assertEqual( [ tuple( c ) for c in self.index.chunks( self.path ) ], self.fresh() )
+		self.assertFalse( self.index.unfinished( self.path ) )
+
+
+class TestShardedDataBase( unittest.TestCase ):
+	def setUp( self ):
+		self.shards = ShardedDataBase()
+		self.db_1 = self.shards.new_shard()
+		self.db_2 = self.shards.new_shard()
+		self.db_1.add( file = '1.jpg', size = 1, created = 1, hash = 'a' )
+		self.db_2.add( file = '2.jpg', size = 1, created = 1, hash = 'b' )
+		self.db_2.add( file = '3.jpg', size = 2, created = 1, hash = 'a' )
+
+	def test_find_fans_out( self ):
+		self.assertEqual( [ i['file'] for i in self.shards.find( size = 1 ) ], [ '1.jpg', '2.jpg' ] )
+		self.assertEqual( [ i['file'] for i in self.shards.find( hash = 'a' ) ], [ '1.jpg', '3.jpg' ] )
+		self.assertEqual( [ i['file'] for i in self.shards.find( flags = { 're': True }, file = '\\d' ) ], [ '1.jpg', '2.jpg', '3.jpg' ] )
+
+	def test_shared_index( self ):
+		self.assertEqual( self.shards.shared['hash']['a'], { self.db_1, self.db_2 } )
+		self.db_2.remove( file = '3.jpg' )
+		self.assertEqual( self.shards.shared['hash']['a'], { self.db_1 } )
+		self.db_1.update( { 'file': '1.jpg' }, { 'hash': 'c' } )
+		self.assertNotIn( 'a', self.shards.shared['hash'] )
+		with unittest.mock.patch.object( self.db_2, 'find', wraps = self.db_2.find ) as find_test:
+			self.assertEqual( [ db for db, i in self.shards.find_in( hash = 'c' ) ], [ self.db_1 ] )
+			find_test.assert_not_called()
+
+	def test_reload_shard( self ):
+		self.db_2.db = deepcopy( DataBase.EMPTY_DB )
+		self.assertEqual( self.shards.shared['hash'], { 'a': { self.db_1 } } )
+		self.assertEqual( self.shards.find( size = 1 ), self.db_1.find( size = 1 ) )
+
+
+class TestSqliteStorage( unittest.TestCase ):
+	dbFile = 'TEST_DIR/test_db.sqlite'
+
+	def setUp( self ):
+		self.db = DataBase( SqliteStorage( self.dbFile ) )
+		self.db.load_db( 'TEST_DIR/no_such_db' )
+
+	def tearDown( self ):
+		self.db.storage.close()
+		os.unlink( self.dbFile )
+
+	def reopen( self ):
+		self.db.storage.close()
+		db = DataBase( SqliteStorage( self.dbFile ) )
+		db.load_db( 'TEST_DIR/no_such_db' )
+		self.db = db
+		return db
+
+	def test_empty( self ):
+		self.assertEqual( self.reopen().db, DataBase.EMPTY_DB )
+
+	def test_add_update_remove_persist( self ):
+		self.db.add( file = 'filename', dir = 'dir', hash = 'xxx', tags = {'tag'} )
+		self.db.add( file = 'filename_2', dir = 'dir', hash = 'yyy' )
+		self.db.update( {'file': 'filename', 'dir': 'dir'}, {'hash': 'new'} )
+		self.db.remove( file = 'filename_2' )
+		db = self.reopen()
+		self.assertEqual( len( db.db['media'] ), 1 )
+		self.assertEqual( db.find( hash = 'new' )[0]['tags'], {'tag'} )
+		self.assertEqual( db.db['tags'], {'tag': 1} )
+
+	def test_rename_dir_persist( self ):
+		for i in range( 3 ):
+			self.db.add( file = str( i ), dir = 'dir', hash = 'xxx' )
+		self.db.rename_dir( 'dir', 'new_dir' )
+		self.assertEqual( [ i['dir'] for i in self.reopen().db['media'] ], [ 'new_dir' ] * 3 )
+
+	def test_update_single_commit( self ):
+		for i in range( 5 ):
+			self.db.add( file = str( i ), dir = 'dir', hash = 'xxx' )
+		self.db.storage.conn = unittest.mock.MagicMock( wraps = self.db.storage.conn )
+		self.db.update( {'dir': 'dir'}, {'dir': 'new_dir'} )
+		self.assertEqual( self.db.storage.conn.commit.call_count, 1 )
+		self.db.remove( dir = 'new_dir' )
+		self.assertEqual( self.db.storage.conn.commit.call_count, 2 )
+		self.assertEqual( self.reopen().db['media'], [] )
+
+	def test_add_many_single_commit( self ):
+		self.db.storage.conn = unittest.mock.MagicMock( wraps = self.db.storage.conn )
+		self.db.add_many( { 'file': str( i ), 'hash': str( i ) } for i in range( 100 ) )
+		self.assertEqual( self.db.storage.conn.commit.call_count, 1 )
+		self.assertEqual( len( self.reopen().db['media'] ), 100 )
+
+	def test_import_pickle( self ):
+		data = { 'dir': 'TEST_DIR', 'tags': {'Unsorted': 1}, 'media': [ { 'file': 'f', 'dir': '', 'size': 1, 'created': 2, 'hash': 'xxx',
+																		   'tags': {'Unsorted'}, 'url': None, 'google': None } ] }
+		self.db.storage.close()
+		os.unlink( self.dbFile )
+		with open( 'TEST_DIR/test_db', 'wb' ) as f:
+			pickle.dump( data, f )
+		self.db = DataBase( SqliteStorage( self.dbFile ) )
+		self.db.load_db( 'TEST_DIR/test_db' )
+		os.unlink( 'TEST_DIR/test_db' )
+		self.db.update( { 'file': 'f' }, { 'hash': 'new' } )				# Импортированные записи можно менять сразу
+		self.assertEqual( self.reopen().find( file = 'f' )[0]['hash'], 'new' )
+		data['media'][0]['hash'] = 'new'
+		self.assertEqual( self.db.db, data )
+
+	def test_update_remove_after_reopen( self ):
+		self.db.add( file = 'filename', dir = 'dir', hash = 'xxx' )
+		self.db.add( file = 'filename_2', dir = 'dir', hash = 'yyy' )
+		db = self.reopen()
+		db.update( { 'file': 'filename', 'dir': 'dir' }, { 'hash': 'new' } )
+		db.remove( file = 'filename_2' )
+		db = self.reopen()
+		self.assertEqual( [ ( i['file'], i['hash'] ) for i in db.db['media'] ], [ ( 'filename', 'new' ) ] )
+
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
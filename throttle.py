@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import platform
+import threading
+import metrics
+
+try:
+	import ctypes															# Необязательно: без него ionice не выставляется, остаётся только nice
+except ImportError:
+	ctypes = None
+
+LOW_NICE = 19
+IOPRIO_WHO_PROCESS = 1														# В Linux это и отдельный поток
+IOPRIO_CLASS_IDLE = 3														# Диск достаётся, только когда он больше никому не нужен
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET = { 'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273 }	# Номер системного вызова ioprio_set
+
+class TokenBucket:															# Не больше rate байт в секунду в среднем, burst - сколько можно сразу после простоя
+	def __init__( self, rate = None, burst = None, clock = time.monotonic, sleep = time.sleep ):
+		self.clock = clock
+		self.sleep = sleep
+		self.lock = threading.Lock()
+		self.set_rate( rate, burst )
+
+	def set_rate( self, rate, burst = None ):								# rate None или 0 - без ограничения
+		with self.lock:
+			self.rate = rate
+			self.burst = burst if burst != None else rate or 0
+			self.tokens = self.burst
+			self.last = self.clock()
+
+	def take( self, n ):													# Ждёт, пока n байт уложатся в бюджет; возвращает, сколько секунд ждал
+		if not self.rate:
+			return 0.0
+		with self.lock:
+			now = self.clock()
+			self.tokens = min( self.burst, self.tokens + ( now - self.last ) * self.rate )
+			self.last = now
+			self.tokens -= n												# Уходим в долг: большой запрос не ждёт, пока накопится весь
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+		if wait > 0:
+			metrics.METRICS.observe( 'throttle_wait', wait )
+			self.sleep( wait )
+		return wait
+
+
+def low_priority():															# Текущий поток - с nice 19 и классом ввода-вывода idle; True, если удалось
+	if not sys.platform.startswith( 'linux' ):								# В других системах приоритет меняется только у всего процесса
+		return False
+	tid = threading.get_native_id()
+	done = False
+	try:
+		os.setpriority( os.PRIO_PROCESS, tid, LOW_NICE )
+		done = True
+	except OSError:
+		pass
+	number = IOPRIO_SET.get( platform.machine() )
+	if ctypes != None and number != None:
+		try:
+			libc = ctypes.CDLL( None, use_errno = True )
+			done = libc.syscall( number, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT ) == 0 or done
+		except OSError:
+			pass
+	return done
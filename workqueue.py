@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import threading
+import time
+import metrics
+
+class WorkQueue:															# Ограниченная очередь заданий с приоритетами и статистикой
+	PRIORITIES = { 'event': 0, 'query': 1, 'hash': 2, 'rescan': 3, 'process': 3 }		# Меньше - раньше
+	DEFAULT_PRIORITY = 1
+	QUIT_PRIORITY = 9														# 'quit' выполняется, когда остальная работа уже разобрана
+	BACKGROUND_PRIORITY = 3													# Такие задания не занимают запас мест, оставленный живым событиям
+
+	def __init__( self, maxsize = 0, reserve = None ):
+		self.maxsize = maxsize
+		self.reserve = reserve if reserve != None else maxsize // 10
+		self.heap = []
+		self.counter = itertools.count()
+		self.cond = threading.Condition()
+		self.processed = 0
+		self.maxDepth = 0
+		self.lag = 0.0
+		self.maxLag = 0.0
+
+	def _priority( self, item ):
+		if isinstance( item, str ):
+			return self.QUIT_PRIORITY
+		try:
+			return self.PRIORITIES.get( item[0], self.DEFAULT_PRIORITY )
+		except ( TypeError, IndexError ):
+			return self.DEFAULT_PRIORITY
+
+	def put( self, item, priority = None, force = False ):					# force - не ждать места ( задания из самих обработчиков )
+		if priority == None:
+			priority = self._priority( item )
+		limit = self.maxsize if priority >= self.BACKGROUND_PRIORITY else self.maxsize + self.reserve
+		with self.cond:
+			while not force and self.maxsize > 0 and len( self.heap ) >= limit:
+				self.cond.wait()
+			heapq.heappush( self.heap, ( priority, next( self.counter ), time.monotonic(), item ) )
+			self.maxDepth = max( self.maxDepth, len( self.heap ) )
+			metrics.METRICS.gauge( 'queue_depth', len( self.heap ) )
+			self.cond.notify_all()
+
+	def get( self, block = True ):
+		with self.cond:
+			while not self.heap:
+				if not block:
+					return None
+				self.cond.wait()
+			priority, n, queued, item = heapq.heappop( self.heap )
+			self.lag = time.monotonic() - queued
+			self.maxLag = max( self.maxLag, self.lag )
+			self.processed += 1
+			metrics.METRICS.gauge( 'queue_depth', len( self.heap ) )
+			metrics.METRICS.observe( 'queue_lag', self.lag )
+			self.cond.notify_all()
+			return item
+
+	def qsize( self ):
+		with self.cond:
+			return len( self.heap )
+
+	def stats( self ):
+		with self.cond:
+			return { 'depth': len( self.heap ), 'max_depth': self.maxDepth, 'processed': self.processed,
+					 'lag': self.lag, 'max_lag': self.maxLag }